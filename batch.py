@@ -0,0 +1,188 @@
+from src.plot_formatting import RENDER_PROFILES, DEFAULT_RENDER_PROFILE
+from concurrent.futures.process import BrokenProcessPool
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from src.album_art import set_search_processes
+from src.ingest import VALID_FILE_PATTERN
+from src.lazy_imports import lazy_import
+import contextlib
+import traceback
+import argparse
+import time
+import sys
+import os
+import re
+
+try:
+    import resource
+except ImportError:
+    # windows, memory limits are not available there
+    resource = None
+
+plt = lazy_import('matplotlib.pyplot')
+
+BATCH_LOG_FILE = 'batch.log'
+# the album art every user shares, a folder next to the users' folders in the output directory
+BATCH_ALBUM_ART_DIR = 'album_art_dir'
+
+
+def is_export_dir(path):
+    return os.path.isdir(path) and any(re.match(VALID_FILE_PATTERN, f) for f in os.listdir(path))
+
+
+def find_exports(paths, album_art_dir=None):
+    # each path is a user's export folder or a folder of them, returns [(user, json_dir)] named after the folders.
+    # the shared album art folder is never a user, even when the output directory is scanned again
+    skipped = set() if album_art_dir is None else {os.path.realpath(album_art_dir)}
+    exports = []
+    for path in paths:
+        if os.path.realpath(path) in skipped:
+            continue
+        if is_export_dir(path):
+            exports.append(path)
+        elif os.path.isdir(path):
+            exports.extend(os.path.join(path, f) for f in sorted(os.listdir(path))
+                           if os.path.realpath(os.path.join(path, f)) not in skipped and is_export_dir(os.path.join(path, f)))
+        else:
+            print(f'- Skipping {path}, not a directory')
+
+    users = []
+    # a user's output folder must not be the shared album art folder
+    names = {BATCH_ALBUM_ART_DIR}
+    for json_dir in exports:
+        name = os.path.basename(os.path.normpath(json_dir))
+        user = name
+        suffix = 2
+        while user in names:
+            user = f'{name}_{suffix}'
+            suffix += 1
+        names.add(user)
+        users.append((user, json_dir))
+    return users
+
+
+def max_rss_mb():
+    if resource is None:
+        return 0
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2 ** 20 if sys.platform == 'darwin' else max_rss / 2 ** 10
+
+
+def init_worker(memory_limit_mb, workers):
+    # workers live across users, pandas, matplotlib and the fonts are loaded once per worker rather than per user.
+    # they search for album art at the same time, so each gets its share of the search rate
+    plt.switch_backend('Agg')
+    set_search_processes(workers)
+    if memory_limit_mb is not None and resource is not None:
+        limit = memory_limit_mb * 2 ** 20
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def process_user(user, json_dir, output_dir, album_art_dir, darkmode=True, rebuild=False, profile=DEFAULT_RENDER_PROFILE):
+    from main import create_charts
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    # the usual progress output goes to the user's log, the batch only reports a line per user
+    start = time.perf_counter()
+    result = {'user': user, 'ok': False, 'error': None, 'failed_charts': 0}
+    with open(os.path.join(output_dir, BATCH_LOG_FILE), 'w') as log, contextlib.redirect_stdout(log):
+        try:
+            result['failed_charts'] = create_charts(json_dir, output_dir, darkmode=darkmode, jobs=1, rebuild=rebuild, profile=profile, album_art_dir=album_art_dir)
+            result['ok'] = result['failed_charts'] == 0
+            if not result['ok']:
+                result['error'] = f"{result['failed_charts']} charts failed"
+        except MemoryError:
+            print(traceback.format_exc())
+            result['error'] = 'ran out of memory'
+        except Exception as e:
+            print(traceback.format_exc())
+            result['error'] = f'{type(e).__name__}: {e}'
+
+    result['seconds'] = time.perf_counter() - start
+    result['max_rss_mb'] = max_rss_mb()
+    return result
+
+
+def print_result(result):
+    status = 'done' if result['ok'] else f"failed ({result['error']})"
+    print(f"- {result['user']}: {status} in {result['seconds']:.1f}s, worker peak {result['max_rss_mb']:.0f} MB")
+
+
+def run_isolated(user, json_dir, output_root, album_art_dir, memory_limit_mb, workers, darkmode, rebuild, profile):
+    # a pool of one, if its worker dies this user is the one that killed it
+    with ProcessPoolExecutor(max_workers=1, initializer=init_worker, initargs=(memory_limit_mb, workers)) as executor:
+        try:
+            return executor.submit(process_user, user, json_dir, os.path.join(output_root, user), album_art_dir, darkmode=darkmode, rebuild=rebuild, profile=profile).result()
+        except BrokenProcessPool:
+            return {'user': user, 'ok': False, 'error': 'worker process died', 'failed_charts': 0, 'seconds': 0, 'max_rss_mb': 0}
+
+
+def run_batch(users, output_root, workers=None, memory_limit_mb=None, darkmode=True, rebuild=False, profile=DEFAULT_RENDER_PROFILE):
+    # one album art store for every user, a cover is fetched once for the whole batch
+    album_art_dir = os.path.join(output_root, BATCH_ALBUM_ART_DIR)
+    workers = min(workers or os.cpu_count() or 1, len(users))
+
+    results = {}
+    broken = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(memory_limit_mb, workers)) as executor:
+        futures = {executor.submit(process_user, user, json_dir, os.path.join(output_root, user), album_art_dir, darkmode=darkmode, rebuild=rebuild, profile=profile): (user, json_dir)
+                   for user, json_dir in users}
+        for future in as_completed(futures):
+            user, json_dir = futures[future]
+            try:
+                results[user] = future.result()
+            except BrokenProcessPool:
+                # a worker was killed, most likely by the OS for memory, and every user still in the pool went with it
+                broken.append((user, json_dir))
+                continue
+            print_result(results[user])
+
+    if broken:
+        # the users caught in it run again each in a process of their own, so only the one that kills its worker fails
+        print(f'- A worker process died, running {len(broken)} users again one per process...')
+        with ThreadPoolExecutor(max_workers=workers) as threads:
+            futures = {threads.submit(run_isolated, user, json_dir, output_root, album_art_dir, memory_limit_mb, workers, darkmode, rebuild, profile): user
+                       for user, json_dir in broken}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                print_result(results[futures[future]])
+
+    return [results[user] for user, _ in users]
+
+
+def main(paths, output_root, workers=None, memory_limit_mb=None, darkmode=True, rebuild=False, profile=DEFAULT_RENDER_PROFILE):
+    users = find_exports(paths, album_art_dir=os.path.join(output_root, BATCH_ALBUM_ART_DIR))
+    if not users:
+        print('- No Spotify exports found')
+        return 1
+
+    if not os.path.exists(output_root):
+        os.makedirs(output_root)
+    if memory_limit_mb is not None and resource is None:
+        print('- Memory limits are not supported on this platform, running without')
+
+    print(f'- Processing {len(users)} users...')
+    start = time.perf_counter()
+    results = run_batch(users, output_root, workers=workers, memory_limit_mb=memory_limit_mb, darkmode=darkmode, rebuild=rebuild, profile=profile)
+
+    failed = [result for result in results if not result['ok']]
+    print()
+    print(f'- {len(results) - len(failed)} of {len(results)} users done in {time.perf_counter() - start:.1f}s')
+    for result in failed:
+        print(f"- {result['user']} failed: {result['error']}, see {os.path.join(output_root, result['user'], BATCH_LOG_FILE)}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Summary statistics for many users\' Spotify data')
+    parser.add_argument('inputs', type=str, nargs='+', help='Export folders (containing json files from Spotify) or folders of them, one per user')
+    parser.add_argument('--output_dir', '-o', type=str, default=os.path.expanduser("~/Downloads/spotify_summary_plots"), help='Directory to save output, every user gets a folder named after their export folder')
+    parser.add_argument('--workers', '-w', type=int, default=None, help='Number of users processed at once (default: number of CPUs)')
+    parser.add_argument('--memory_limit_mb', '-m', type=int, default=None, help='Address space limit of each worker process in MB, a user that exceeds it fails instead of the whole batch')
+    parser.add_argument('--lightmode', '-l', help='Use light mode for plots', action='store_true', default=False)
+    parser.add_argument('--rebuild', help='Ignore the caches and re-read every json file', action='store_true', default=False)
+    parser.add_argument('--profile', '-p', type=str, choices=list(RENDER_PROFILES), default=DEFAULT_RENDER_PROFILE, help=f'Render quality of the charts (default: {DEFAULT_RENDER_PROFILE})')
+    args = parser.parse_args()
+
+    sys.exit(main(args.inputs, args.output_dir, workers=args.workers, memory_limit_mb=args.memory_limit_mb, darkmode=not args.lightmode, rebuild=args.rebuild, profile=args.profile))
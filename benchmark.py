@@ -0,0 +1,288 @@
+from src.synthetic_history import generate_history
+from src.plot_formatting import RENDER_PROFILES
+from src.leaderboards import create_leaderboard_charts
+from src.ingest import list_history_files, read_history_files
+from src.top_podcasts import create_podcast_charts
+from src.streamgraphs import create_streamgraphs
+from src.top_artists import create_artist_charts
+from src.top_albums import create_album_charts
+from src.top_tracks import create_track_charts
+from src.cube import build_listening_cube, CUBE_KINDS
+from src.rolling import rolling_top_k
+from src.history import SpotifyHistory
+from main import load_data, format_df
+from PIL import Image
+import pandas as pd
+import numpy as np
+import matplotlib
+import http.server
+import urllib.parse
+import contextlib
+import statistics
+import tracemalloc
+import threading
+import platform
+import argparse
+import tempfile
+import hashlib
+import shutil
+import time
+import json
+import sys
+import io
+import os
+
+BENCHMARK_SCHEMA_VERSION = 1
+STAGES = ['load_data_cold', 'load_data_warm', 'format_df', 'build_listening_cube', 'create_artist_charts', 'create_track_charts',
+          'create_podcast_charts', 'create_album_charts', 'create_streamgraphs', 'create_podcast_streamgraphs', 'rolling_top_k',
+          'create_leaderboard_charts']
+CHART_STAGES = [stage for stage in STAGES if stage.startswith('create_')]
+
+# a stage regresses when its median time or peak memory grows by more than this, and by more than the noise floor
+DEFAULT_THRESHOLD = 0.1
+NOISE_FLOOR_SECONDS = 0.05
+NOISE_FLOOR_MB = 1.0
+
+
+class ArtHandler(http.server.BaseHTTPRequestHandler):
+    # stands in for the iTunes search API so album chart timings don't depend on the network.
+    # every search finds an album, each with its own cover
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path == '/search':
+            term = urllib.parse.parse_qs(url.query)['term'][0]
+            cover = hashlib.sha1(term.encode('utf-8')).hexdigest()[:12]
+            body = json.dumps({'results': [{'artworkUrl100': f'http://127.0.0.1:{self.server.server_port}/art/{cover}.jpg'}]}).encode()
+        else:
+            body = self.server.cover(url.path)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_art_server():
+    def cover(path):
+        digest = hashlib.sha1(path.encode('utf-8')).digest()
+        buffer = io.BytesIO()
+        Image.new('RGB', (100, 100), tuple(digest[:3])).save(buffer, 'JPEG')
+        return buffer.getvalue()
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ArtHandler)
+    server.cover = cover
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def synthetic_data_dir(data_dir, num_plays, seed):
+    # generated histories are kept between benchmark runs, 10M plays take a while to write
+    json_dir = os.path.join(data_dir, f'plays_{num_plays}_seed_{seed}')
+    marker = os.path.join(json_dir, 'complete')
+    if not os.path.exists(marker):
+        print(f'- Generating {num_plays} synthetic plays in {json_dir}...')
+        if os.path.exists(json_dir):
+            shutil.rmtree(json_dir)
+        generate_history(json_dir, num_plays, seed=seed)
+        with open(marker, 'w') as fp:
+            fp.write('')
+    return json_dir
+
+
+def measure(setup, run, repeat, trace_memory=True, charts=False):
+    # the timed runs go untraced, tracemalloc slows allocation heavy code down a lot. one more run measures the peak.
+    # chart stages return how many charts failed, a run that skips charts is not timing the real work
+    seconds = []
+    failed_charts = 0
+    for _ in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            outcome = run(state)
+        seconds.append(time.perf_counter() - start)
+        if charts:
+            failed_charts = max(failed_charts, outcome)
+
+    result = {'seconds': seconds, 'min': min(seconds), 'median': statistics.median(seconds)}
+    if charts:
+        result['failed_charts'] = failed_charts
+    if trace_memory:
+        state = setup()
+        tracemalloc.start()
+        with contextlib.redirect_stdout(io.StringIO()):
+            run(state)
+        result['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    return result
+
+
+def benchmark_plays(json_dir, work_dir, stages, repeat=3, jobs=1, profile='draft', trace_memory=True):
+    def fresh_dir():
+        return tempfile.mkdtemp(dir=work_dir)
+
+    # inputs shared by the stages, built once and outside the timings
+    with contextlib.redirect_stdout(io.StringIO()):
+        warm_dir = fresh_dir()
+        df, podcasts_df = load_data(json_dir, warm_dir, jobs=jobs)
+        raw_df = read_history_files(list_history_files(json_dir), jobs=jobs)
+        cube = build_listening_cube(df, podcasts_df)
+
+    art_server = None
+    search_url = None
+    art_dir = None
+    if 'create_album_charts' in stages:
+        art_server = start_art_server()
+        search_url = f'http://127.0.0.1:{art_server.server_port}/search'
+        # fetch the covers once, the timed runs start from a warm art index like any rerun does
+        art_output_dir = fresh_dir()
+        with contextlib.redirect_stdout(io.StringIO()):
+            create_album_charts(cube['album'], art_output_dir, top_n=10, search_url=search_url, profile=profile)
+        art_dir = os.path.join(art_output_dir, 'top_albums', 'album_art_dir')
+
+    def album_setup():
+        output_dir = fresh_dir()
+        shutil.copytree(art_dir, os.path.join(output_dir, 'top_albums', 'album_art_dir'), ignore=shutil.ignore_patterns('thumbnails'))
+        return output_dir
+
+    def raw_frame():
+        return pd.concat(raw_df, ignore_index=True)
+
+    # name: (setup, run(state))
+    stage_funcs = {
+        'load_data_cold': (fresh_dir, lambda output_dir: load_data(json_dir, output_dir, jobs=jobs)),
+        'load_data_warm': (lambda: warm_dir, lambda output_dir: load_data(json_dir, output_dir, jobs=jobs)),
+        'format_df': (raw_frame, format_df),
+        'build_listening_cube': (lambda: None, lambda state: build_listening_cube(df, podcasts_df)),
+        'create_artist_charts': (fresh_dir, lambda output_dir: create_artist_charts(cube['artist'], output_dir, top_n=20, jobs=jobs, profile=profile)),
+        'create_track_charts': (fresh_dir, lambda output_dir: create_track_charts(cube['track'], output_dir, top_n=20, jobs=jobs, profile=profile)),
+        'create_podcast_charts': (fresh_dir, lambda output_dir: create_podcast_charts(cube['podcast'], output_dir, top_n=20, jobs=jobs, profile=profile)),
+        'create_album_charts': (album_setup, lambda output_dir: create_album_charts(cube['album'], output_dir, top_n=10, search_url=search_url, profile=profile)),
+        'create_streamgraphs': (fresh_dir, lambda output_dir: create_streamgraphs(cube, output_dir, top_n=10, jobs=jobs, profile=profile)),
+        'create_podcast_streamgraphs': (fresh_dir, lambda output_dir: create_streamgraphs(cube, output_dir, top_n=10, podcasts=True, jobs=jobs, profile=profile)),
+        'rolling_top_k': (lambda: None, lambda state: [rolling_top_k(podcasts_df if kind == 'podcast' else df, entity_cols, window_days=30, k=10) for kind, entity_cols in CUBE_KINDS.items()]),
+        # a new history each run, so the rolling rankings are computed and not memoized
+        'create_leaderboard_charts': (fresh_dir, lambda output_dir: create_leaderboard_charts(SpotifyHistory(df, podcasts_df), output_dir, top_n=10, jobs=jobs, profile=profile)),
+    }
+
+    results = {}
+    try:
+        for stage in stages:
+            setup, run = stage_funcs[stage]
+            results[stage] = measure(setup, run, repeat, trace_memory=trace_memory, charts=stage in CHART_STAGES)
+            peak = f", peak {results[stage]['peak_mb']:.1f} MB" if 'peak_mb' in results[stage] else ''
+            failed = f", {results[stage]['failed_charts']} charts failed" if results[stage].get('failed_charts') else ''
+            print(f"  {stage:<30} median {results[stage]['median']:.3f}s (min {results[stage]['min']:.3f}s){peak}{failed}")
+    finally:
+        if art_server is not None:
+            art_server.shutdown()
+    return results
+
+
+def environment_info():
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'matplotlib': matplotlib.__version__,
+    }
+
+
+def compare_results(results, baseline, threshold=DEFAULT_THRESHOLD):
+    # prints current vs baseline per stage, returns the regressions
+    if baseline.get('schema_version') != BENCHMARK_SCHEMA_VERSION:
+        print('- Baseline was written by another version of the benchmark, not comparing')
+        return []
+    if baseline['params'] != results['params']:
+        print(f"- Baseline parameters differ ({baseline['params']} vs {results['params']}), comparing anyway")
+
+    regressions = []
+    print(f"{'plays':>10} {'stage':<30} {'baseline':>10} {'current':>10} {'change':>8}")
+    for num_plays, stages in results['runs'].items():
+        for stage, result in stages.items():
+            base = baseline['runs'].get(num_plays, {}).get(stage)
+            if base is None:
+                continue
+
+            change = result['median'] / base['median'] - 1 if base['median'] > 0 else 0
+            flag = ''
+            if change > threshold and result['median'] - base['median'] > NOISE_FLOOR_SECONDS:
+                regressions.append((num_plays, stage, 'time', change))
+                flag = ' slower'
+            if 'peak_mb' in result and 'peak_mb' in base and base['peak_mb'] > 0:
+                memory_change = result['peak_mb'] / base['peak_mb'] - 1
+                if memory_change > threshold and result['peak_mb'] - base['peak_mb'] > NOISE_FLOOR_MB:
+                    regressions.append((num_plays, stage, 'memory', memory_change))
+                    flag += f' memory +{memory_change:.0%}'
+            print(f"{num_plays:>10} {stage:<30} {base['median']:>9.3f}s {result['median']:>9.3f}s {change:>+8.1%}{flag}")
+
+    return regressions
+
+
+def main(plays, output, stages=STAGES, repeat=3, jobs=1, profile='draft', seed=0, data_dir=None, baseline=None, threshold=DEFAULT_THRESHOLD, trace_memory=True):
+    if data_dir is None:
+        data_dir = os.path.join(tempfile.gettempdir(), 'spotify_benchmark_data')
+
+    results = {
+        'schema_version': BENCHMARK_SCHEMA_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': environment_info(),
+        'params': {'repeat': repeat, 'jobs': jobs, 'profile': profile, 'seed': seed},
+        'runs': {},
+    }
+
+    work_dir = tempfile.mkdtemp(prefix='spotify_benchmark_')
+    try:
+        for num_plays in plays:
+            json_dir = synthetic_data_dir(data_dir, num_plays, seed)
+            print(f'- Benchmarking {num_plays} plays...')
+            results['runs'][str(num_plays)] = benchmark_plays(json_dir, work_dir, stages, repeat=repeat, jobs=jobs, profile=profile, trace_memory=trace_memory)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    temp_path = f'{output}.tmp'
+    with open(temp_path, 'w') as fp:
+        json.dump(results, fp, indent=2)
+    os.replace(temp_path, output)
+    print(f'- Results saved to {output}')
+
+    # timings of stages whose charts failed don't mean anything, never pass them off as a clean run
+    failed_charts = sum(result.get('failed_charts', 0) for stages in results['runs'].values() for result in stages.values())
+    if failed_charts:
+        print(f'- {failed_charts} charts failed, the timings of their stages are not comparable')
+        status = 1
+    else:
+        status = 0
+
+    if baseline is not None:
+        print()
+        with open(baseline, 'r') as fp:
+            regressions = compare_results(results, json.load(fp), threshold=threshold)
+        if regressions:
+            print(f'- {len(regressions)} regressions against {baseline}')
+            status = 1
+    return status
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time and measure the memory of each pipeline stage on synthetic Spotify histories')
+    parser.add_argument('--plays', '-n', type=int, nargs='+', default=[100000], help='Number of plays to generate, one benchmark per value (default: 100000)')
+    parser.add_argument('--output', '-o', type=str, default='benchmark_results.json', help='File to save the results to')
+    parser.add_argument('--baseline', '-b', type=str, default=None, help='Earlier results file to compare against, exits with 1 on a regression')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help=f'Relative slowdown or memory growth that counts as a regression (default: {DEFAULT_THRESHOLD})')
+    parser.add_argument('--stages', type=str, nargs='+', choices=STAGES, default=STAGES, help='Stages to run (default: all)')
+    parser.add_argument('--repeat', '-r', type=int, default=3, help='Timed runs per stage (default: 3)')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='Worker processes for reading and rendering (default: 1, memory of other processes is not measured)')
+    parser.add_argument('--profile', '-p', type=str, choices=list(RENDER_PROFILES), default='draft', help='Render profile for the chart stages (default: draft)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic history generator')
+    parser.add_argument('--data_dir', type=str, default=None, help='Where generated histories are kept between runs (default: a directory in the system temp dir)')
+    parser.add_argument('--no_memory', help='Skip the extra traced run per stage that measures peak memory', action='store_true', default=False)
+    args = parser.parse_args()
+
+    sys.exit(main(args.plays, args.output, stages=args.stages, repeat=args.repeat, jobs=args.jobs, profile=args.profile, seed=args.seed,
+                  data_dir=args.data_dir, baseline=args.baseline, threshold=args.threshold, trace_memory=not args.no_memory))
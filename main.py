@@ -1,16 +1,14 @@
-from src.top_podcasts import create_podcast_charts
-from src.streamgraphs import create_streamgraphs
-from src.top_artists import create_artist_charts
-from src.top_albums import create_album_charts
-from src.top_tracks import create_track_charts
-import pandas as pd
+from src.tracing import traced, count, start_tracing, stop_tracing, write_chrome_trace, print_trace_summary
+from src.plot_formatting import RENDER_PROFILES, DEFAULT_RENDER_PROFILE
+from src.lazy_imports import lazy_import
 import argparse
 import os
-import re
 
+# pandas and the data modules are imported where they are used, so --help and argument errors return right away
+pd = lazy_import('pandas')
 
-def format_df(df):
-    print('- Formatting data...')
+
+def add_time_columns(df):
     df['ts'] = pd.to_datetime(df['ts'])
     df = df.sort_values(by=['ts'])
 
@@ -19,15 +17,31 @@ def format_df(df):
     df['month'] = df['ts'].dt.month
     df['day'] = df['ts'].dt.day
     df['hour'] = df['ts'].dt.hour
+    return df
+
+
+@traced
+def format_df(df, podcasts_df=None, title_memo=None):
+    from src.entities import encode_entities, remap_categories, add_clean_titles
+
+    print('- Formatting data...')
+    df = add_time_columns(df)
 
-    podcasts_df = df[~df['episode_name'].isna()]
-    df = df[df['episode_name'].isna()]
+    # the streaming reader hands over music and podcasts already split
+    if podcasts_df is None:
+        podcasts_df = df[~df['episode_name'].isna()]
+        df = df[df['episode_name'].isna()]
+    else:
+        podcasts_df = add_time_columns(podcasts_df)
     print(f"- Filtered out {int(podcasts_df['ms_played'].sum()/3600000)} hours of listening from {len(podcasts_df['episode_show_name'].unique())} different podcasts")
 
     # rename column names
     df = df.rename(columns={'master_metadata_album_artist_name': 'artist', 'master_metadata_album_album_name': 'album', 'master_metadata_track_name': 'track'})
     podcasts_df = podcasts_df.rename(columns={'episode_name': 'episode', 'episode_show_name': 'podcast'})
 
+    df = encode_entities(df)
+    podcasts_df = encode_entities(podcasts_df)
+
     aliases_to_replace = {
         'DOOM': 'MF DOOM',
         'Viktor Vaughn': 'MF DOOM',
@@ -42,85 +56,164 @@ def format_df(df):
     }
 
     # Replace all artist aliases
-    num_replaced = len(df[df['artist'].isin(aliases_to_replace.keys())])
-    df['artist'] = df['artist'].replace(aliases_to_replace)
+    num_replaced = int(df['artist'].isin(aliases_to_replace.keys()).sum())
+    df['artist'] = remap_categories(df['artist'], aliases_to_replace)
 
     if num_replaced > 0:
         print(f"- Renamed {num_replaced} aliases with artist name")
 
+    # normalized track/album titles shared by the streamgraphs and the album art search
+    df = add_clean_titles(df, title_memo if title_memo is not None else {})
+
+    count('rows_formatted', len(df) + len(podcasts_df))
     return df, podcasts_df
 
 
-def cast_bool_to_numeric(df):
-    bool_cols = df.select_dtypes(include=bool).columns
-    df[bool_cols] = df[bool_cols].astype(int)
-    return df
+def drop_duplicate_plays(df, uri_col):
+    # the same play shows up in overlapping exports, identical (ts, uri, ms_played) means one play
+    subset = [col for col in ['ts', uri_col, 'ms_played'] if col in df.columns]
+    return df.drop_duplicates(subset=subset).sort_values(by=['ts']).reset_index(drop=True)
+
+
+@traced
+def read_history(history_files, jobs=None, stream=False, title_memo=None):
+    from src.ingest import read_history_files, stream_history_files
 
+    if stream:
+        streamed = stream_history_files(history_files)
+        # None when not one of the files could be parsed
+        if streamed is None:
+            return None
+        df, podcasts_df = streamed
+        return format_df(df, podcasts_df, title_memo=title_memo)
 
-def load_data(json_dir, output_dir):
-    temp_json = os.path.join(output_dir, 'spotify_data.json')
-    temp_podcasts_json = os.path.join(output_dir, 'spotify_podcasts_data.json')
+    valid_files = read_history_files(history_files, jobs=jobs)
+    # None when not one of the files could be parsed
+    if not valid_files:
+        return None
 
-    if os.path.exists(temp_json):
-        print('- Loading data from json...')
-        df = pd.read_json(temp_json, orient='records')
-        df['ts'] = pd.to_datetime(df['ts'])
+    # Process valid files, concatenating once rather than file by file
+    cumulative_df = pd.concat(valid_files, ignore_index=True)
 
-        podcasts_df = pd.read_json(temp_podcasts_json, orient='records')
-        podcasts_df['ts'] = pd.to_datetime(podcasts_df['ts'])
-        return df, podcasts_df
+    return format_df(cumulative_df, title_memo=title_memo)
+
+
+def shared_columns(frames):
+    columns = [col for col in frames[0].columns if all(col in df.columns for df in frames[1:])]
+    return [df[columns] for df in frames]
+
+
+@traced
+def load_data(json_dir, output_dir, jobs=None, stream=False, rebuild=False):
+    from src.manifest import load_manifest, save_manifest, scan_history_files, print_manifest_report
+    from src.entities import concat_frames, load_title_memo, save_title_memo
+    from src.data_cache import load_cache, save_cache
+    from src.ingest import list_history_files
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    history_files = list_history_files(json_dir)
+
+    cached = None if rebuild else load_cache(output_dir)
+    # without a cache to merge into every file counts as new
+    previous_files = load_manifest(output_dir) if cached is not None else {}
+    manifest_files, changes = scan_history_files(history_files, previous_files)
+    print_manifest_report(changes)
+
+    files_to_read = changes['new'] + changes['changed']
+    if cached is not None and not files_to_read:
+        print('- Loading data from cache...')
+        df, podcasts_df = cached
+        count('rows_from_cache', len(df) + len(podcasts_df))
+
+        # only mtimes moved, remember them so the files are not hashed again next run
+        if manifest_files != previous_files:
+            save_manifest(output_dir, manifest_files)
     else:
-        print(f'- Loading data from {json_dir}...')
-        available_encodings = ['utf-8', 'utf-16', 'latin-1', 'ISO-8859-1']
-        valid_files = []
-        valid_file_pattern = r"Streaming_History.+\.json"
-        for f in os.listdir(json_dir):
-            if not re.match(valid_file_pattern, f):
-                continue
-
-            for encoding in available_encodings:
-                try:
-                    df = pd.read_json(f'{json_dir}/{f}', encoding=encoding)
-                    df = cast_bool_to_numeric(df)
-                    valid_files.append((f, encoding, df))
-                    break
-                except (UnicodeDecodeError, ValueError):
-                    pass
-
-        # Process valid files
-        cumulative_df = None
-        for filename, encoding, df in valid_files:
-            if cumulative_df is None:
-                cumulative_df = df
-            else:
-                cumulative_df = pd.concat([cumulative_df, df])
-
-        df, podcasts_df = format_df(cumulative_df)
-
-        print('- Saving data to json...')
-        # save df to json but make timestamps work
-        df['ts'] = df['ts'].astype(str)
-        df.to_json(temp_json, orient='records')
-
-        podcasts_df['ts'] = podcasts_df['ts'].astype(str)
-        podcasts_df.to_json(temp_podcasts_json, orient='records')
+        print(f'- Loading data from {len(files_to_read)} files in {json_dir}...')
+        title_memo = load_title_memo(output_dir)
+        num_memo_titles = len(title_memo)
+        new_data = read_history(files_to_read, jobs=jobs, stream=stream, title_memo=title_memo)
+        count('history_files_read', len(files_to_read))
+
+        if new_data is None:
+            if cached is None:
+                raise ValueError(f'none of the Spotify history files in {json_dir} could be parsed')
+            # the unreadable files are still recorded in the manifest below, so they are skipped until they change
+            print('- None of them could be parsed, keeping the cached plays')
+            new_data = cached[0].iloc[:0], cached[1].iloc[:0]
+        df, podcasts_df = new_data
+
+        num_new_plays, num_new_podcast_plays = len(df), len(podcasts_df)
+        if cached is not None:
+            # a cache written by the other reading mode has other columns, only keep what both have rather than fill NaNs
+            df = concat_frames(shared_columns([cached[0], df]))
+            podcasts_df = concat_frames(shared_columns([cached[1], podcasts_df]))
+            num_cached_plays, num_cached_podcast_plays = len(cached[0]), len(cached[1])
+        else:
+            num_cached_plays, num_cached_podcast_plays = 0, 0
+
+        df = drop_duplicate_plays(df, 'spotify_track_uri')
+        podcasts_df = drop_duplicate_plays(podcasts_df, 'spotify_episode_uri')
+
+        num_duplicates = num_new_plays + num_new_podcast_plays + num_cached_plays + num_cached_podcast_plays - len(df) - len(podcasts_df)
+        print(f'- Added {len(df) - num_cached_plays} plays and {len(podcasts_df) - num_cached_podcast_plays} podcast plays ({num_duplicates} duplicates dropped)')
+
+        print('- Saving data to cache...')
+        save_cache(output_dir, df, podcasts_df)
+        save_manifest(output_dir, manifest_files)
+        if len(title_memo) > num_memo_titles:
+            save_title_memo(output_dir, title_memo)
 
     print()
     return df, podcasts_df
 
 
-def main(json_dir, output_dir, darkmode=True):
+def main(json_dir, output_dir, darkmode=True, jobs=None, stream=False, rebuild=False, profile=DEFAULT_RENDER_PROFILE, album_art_dir=None, trace_path=None, trace_memory=False):
+    # tracing is off unless a trace file is asked for, the hooks cost a global lookup each when off
+    if trace_path is not None:
+        start_tracing(memory=trace_memory)
+        try:
+            return create_charts(json_dir, output_dir, darkmode=darkmode, jobs=jobs, stream=stream, rebuild=rebuild, profile=profile, album_art_dir=album_art_dir)
+        finally:
+            tracer = stop_tracing()
+            write_chrome_trace(tracer, trace_path)
+            print_trace_summary(tracer)
+            print(f'- Trace saved to {trace_path}')
+    else:
+        return create_charts(json_dir, output_dir, darkmode=darkmode, jobs=jobs, stream=stream, rebuild=rebuild, profile=profile, album_art_dir=album_art_dir)
+
+
+@traced
+def create_charts(json_dir, output_dir, darkmode=True, jobs=None, stream=False, rebuild=False, profile=DEFAULT_RENDER_PROFILE, album_art_dir=None):
+    # returns the number of charts that could not be rendered
+    from src.top_podcasts import plan_podcast_charts
+    from src.leaderboards import plan_leaderboard_charts
+    from src.streamgraphs import plan_streamgraphs
+    from src.top_artists import plan_artist_charts
+    from src.top_albums import plan_album_charts
+    from src.top_tracks import plan_track_charts
+    from src.scheduler import run_chart_jobs
+    from src.history import SpotifyHistory
+
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    df, podcasts_df = load_data(json_dir, output_dir)
+    df, podcasts_df = load_data(json_dir, output_dir, jobs=jobs, stream=stream, rebuild=rebuild)
+    # the charts read the same memoized aggregates the library API serves
+    history = SpotifyHistory(df, podcasts_df)
+
+    # plan every chart up front, then render them across the worker pool
+    chart_jobs = []
+    chart_jobs += plan_podcast_charts(history['podcast'], output_dir, top_n=20, darkmode=darkmode, profile=profile)
+    chart_jobs += plan_streamgraphs(history, output_dir, top_n=10, darkmode=darkmode, podcasts=True, profile=profile)
+    chart_jobs += plan_artist_charts(history['artist'], output_dir, top_n=20, darkmode=darkmode, profile=profile)
+    chart_jobs += plan_streamgraphs(history, output_dir, top_n=10, darkmode=darkmode, profile=profile)
+    chart_jobs += plan_track_charts(history['track'], output_dir, top_n=20, darkmode=darkmode, profile=profile)
+    chart_jobs += plan_leaderboard_charts(history, output_dir, top_n=10, darkmode=darkmode, profile=profile)
+    chart_jobs += plan_album_charts(history['album'], output_dir, top_n=10, album_art_dir=album_art_dir, profile=profile) # There is no darkmode option for top albums (looks better in white)
 
-    create_podcast_charts(podcasts_df, output_dir, top_n=20, darkmode=darkmode)
-    create_streamgraphs(podcasts_df, output_dir, top_n=10, darkmode=darkmode, podcasts=True)
-    create_artist_charts(df, output_dir, top_n=20, darkmode=darkmode)
-    create_streamgraphs(df, output_dir, top_n=10, darkmode=darkmode)
-    create_track_charts(df, output_dir, top_n=20, darkmode=darkmode)
-    create_album_charts(df, output_dir, top_n=10) # There is no darkmode option for top albums (looks better in white)
+    return run_chart_jobs(chart_jobs, jobs=jobs, output_dir=output_dir)
 
 
 if __name__ == "__main__":
@@ -128,10 +221,17 @@ if __name__ == "__main__":
     parser.add_argument('--input_dir', '-i', type=str, help='Directory containing json files from Spotify')
     parser.add_argument('--output_dir', '-o', type=str, default=os.path.expanduser("~/Downloads/spotify_summary_plots"), help='Directory to save output')
     parser.add_argument('--lightmode', '-l', help='Use light mode for plots', action='store_true', default=False)
+    parser.add_argument('--jobs', '-j', type=int, default=None, help='Number of worker processes for reading files and rendering charts (default: number of CPUs)')
+    parser.add_argument('--stream', '-s', help='Read the json files record by record to keep memory bounded', action='store_true', default=False)
+    parser.add_argument('--rebuild', help='Ignore the cache and re-read every json file', action='store_true', default=False)
+    parser.add_argument('--profile', '-p', type=str, choices=list(RENDER_PROFILES), default=DEFAULT_RENDER_PROFILE, help=f'Render quality of the charts (default: {DEFAULT_RENDER_PROFILE})')
+    parser.add_argument('--trace', type=str, default=None, help='Save a Chrome trace of the run to this file and print a per-stage summary')
+    parser.add_argument('--trace_memory', help='With --trace, also follow Python allocations with tracemalloc (slower)', action='store_true', default=False)
     args = parser.parse_args()
 
     if args.input_dir is None:
         print('Please specify a directory containing json files from Spotify')
         exit(1)
 
-    main(json_dir=args.input_dir, output_dir=args.output_dir, darkmode=not args.lightmode)
+    main(json_dir=args.input_dir, output_dir=args.output_dir, darkmode=not args.lightmode, jobs=args.jobs, stream=args.stream, rebuild=args.rebuild, profile=args.profile,
+         trace_path=args.trace, trace_memory=args.trace_memory)
@@ -0,0 +1,37 @@
+from src.plot_formatting import RENDER_PROFILES
+from src.server import SERVE_CACHE_BYTES
+import argparse
+import os
+
+
+def main(json_dir, output_dir, host='127.0.0.1', port=8000, jobs=None, cache_mb=SERVE_CACHE_BYTES // 2 ** 20, stream=False, profile='screen'):
+    from src.server import ChartServer, serve
+    from src.history import SpotifyHistory
+    from main import load_data
+
+    # the data cache is shared with main.py, the served charts get their own directory
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    history = SpotifyHistory(*load_data(json_dir, output_dir, jobs=jobs, stream=stream))
+
+    chart_server = ChartServer(history, os.path.join(output_dir, 'serve'), jobs=jobs or os.cpu_count() or 1, cache_bytes=cache_mb * 2 ** 20, profile=profile)
+    serve(chart_server, host=host, port=port)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve Spotify summary charts over HTTP, rendered on request')
+    parser.add_argument('--input_dir', '-i', type=str, help='Directory containing json files from Spotify')
+    parser.add_argument('--output_dir', '-o', type=str, default=os.path.expanduser("~/Downloads/spotify_summary_plots"), help='Directory for the data cache and album art')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on (default: 8000)')
+    parser.add_argument('--jobs', '-j', type=int, default=None, help='Number of chart rendering processes (default: number of CPUs)')
+    parser.add_argument('--cache_mb', type=int, default=SERVE_CACHE_BYTES // 2 ** 20, help=f'Memory for rendered charts in MB (default: {SERVE_CACHE_BYTES // 2 ** 20})')
+    parser.add_argument('--stream', '-s', help='Read the json files record by record to keep memory bounded', action='store_true', default=False)
+    parser.add_argument('--profile', '-p', type=str, choices=list(RENDER_PROFILES), default='screen', help='Render quality of the charts (default: screen)')
+    args = parser.parse_args()
+
+    if args.input_dir is None:
+        print('Please specify a directory containing json files from Spotify')
+        exit(1)
+
+    main(json_dir=args.input_dir, output_dir=args.output_dir, host=args.host, port=args.port, jobs=args.jobs, cache_mb=args.cache_mb, stream=args.stream, profile=args.profile)
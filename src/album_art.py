@@ -0,0 +1,236 @@
+from concurrent.futures import ThreadPoolExecutor
+from src.entities import normalize_title
+from src.lazy_imports import lazy_import
+from src.tracing import count
+import threading
+import hashlib
+import sqlite3
+import random
+import time
+import os
+import re
+
+requests = lazy_import('requests')
+
+ITUNES_SEARCH_URL = 'https://itunes.apple.com/search'
+
+ART_FETCH_WORKERS = 8
+# the search API throttles bursts, keep well under it
+ART_SEARCH_RATE = 2.0
+ART_SEARCH_BURST = 10
+ART_MAX_RETRIES = 4
+ART_BACKOFF_BASE = 0.5
+ART_TIMEOUT = 10
+# throttled or temporarily unavailable, worth another try after a pause
+RETRY_STATUS_CODES = {403, 429, 500, 502, 503, 504}
+
+ART_INDEX_FILE = 'album_art_index.sqlite'
+# albums the search could not find are looked up again after a week
+ART_NEGATIVE_TTL = 7 * 24 * 3600
+
+# processes searching at the same time, e.g. batch workers, they split the search rate between them
+_search_processes = 1
+
+
+def set_search_processes(processes):
+	global _search_processes
+	_search_processes = max(1, processes)
+
+
+class TokenBucket:
+	def __init__(self, rate, capacity):
+		self.rate = rate
+		self.capacity = capacity
+		self.tokens = capacity
+		self.updated = time.monotonic()
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		while True:
+			with self.lock:
+				now = time.monotonic()
+				self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+				self.updated = now
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+				wait = (1 - self.tokens) / self.rate
+			time.sleep(wait)
+
+
+def art_key(album, artist, clean_album=None):
+	# normalized (album, artist), so 'Album (Deluxe)' and 'Album' by the same artist share one entry
+	if clean_album is None:
+		clean_album = normalize_title(album)
+	return clean_album.strip().casefold(), artist.strip().casefold()
+
+
+def art_file_name(key):
+	# hashed, album titles alone collide and may not be valid file names
+	return hashlib.sha1('\0'.join(key).encode('utf-8')).hexdigest()[:20] + '.jpg'
+
+
+class ArtLookupError(Exception):
+	pass
+
+
+class AlbumArtIndex:
+	def __init__(self, path):
+		self.connection = sqlite3.connect(path)
+		with self.connection:
+			self.connection.execute(
+				'CREATE TABLE IF NOT EXISTS album_art ('
+				'album_key TEXT NOT NULL, artist_key TEXT NOT NULL, found INTEGER NOT NULL, '
+				'artwork_url TEXT, path TEXT, query TEXT, checked_at REAL NOT NULL, '
+				'PRIMARY KEY (album_key, artist_key))'
+			)
+
+	def get(self, key):
+		row = self.connection.execute('SELECT found, artwork_url, path, query, checked_at FROM album_art WHERE album_key = ? AND artist_key = ?', key).fetchone()
+		if row is None:
+			return None
+		return dict(zip(['found', 'artwork_url', 'path', 'query', 'checked_at'], row))
+
+	def put(self, key, found, artwork_url=None, path=None, query=None):
+		with self.connection:
+			self.connection.execute('INSERT OR REPLACE INTO album_art VALUES (?, ?, ?, ?, ?, ?, ?)', (*key, int(found), artwork_url, path, query, time.time()))
+
+	def close(self):
+		self.connection.close()
+
+
+def search_terms(album, artist, clean_album=None):
+	# relaxed step by step: as listed, normalized title, without the artist, title up to the first ':' or '-'
+	if clean_album is None:
+		clean_album = normalize_title(album)
+	clean_album = re.sub(r'\[[^)]*\]', '', clean_album)
+	short_album = album.split(":")[0].strip().split("-")[0].strip()
+
+	terms = []
+	for term in [f'{album} {artist}', f'{clean_album} {artist}', clean_album, short_album]:
+		term = term.strip()
+		if term and term not in terms:
+			terms.append(term)
+	return terms
+
+
+class AlbumArtFetcher:
+	def __init__(self, album_art_dir, search_url=ITUNES_SEARCH_URL, workers=ART_FETCH_WORKERS, rate=None, burst=None):
+		self.album_art_dir = album_art_dir
+		self.search_url = search_url
+		self.workers = workers
+		if rate is None:
+			rate = ART_SEARCH_RATE / _search_processes
+		if burst is None:
+			burst = max(1, ART_SEARCH_BURST // _search_processes)
+		self.bucket = TokenBucket(rate, burst)
+
+		# one pooled session, every worker reuses its connections
+		self.session = requests.Session()
+		adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+		self.session.mount('http://', adapter)
+		self.session.mount('https://', adapter)
+
+	def _get(self, url, params=None, throttle=True):
+		for attempt in range(ART_MAX_RETRIES + 1):
+			if throttle:
+				self.bucket.acquire()
+			count('http_requests')
+			try:
+				response = self.session.get(url, params=params, timeout=ART_TIMEOUT)
+				if response.status_code not in RETRY_STATUS_CODES:
+					return response
+			except (requests.ConnectionError, requests.Timeout):
+				pass
+
+			if attempt < ART_MAX_RETRIES:
+				count('http_retries')
+				# exponential backoff with jitter so the workers don't retry in lockstep
+				time.sleep(ART_BACKOFF_BASE * 2 ** attempt * (1 + random.random()))
+
+		return None
+
+	def fetch(self, album, artist, clean_album, path):
+		# returns (artwork_url, query) or None when every query came back empty,
+		# raises ArtLookupError when a query could not be answered so the miss is not cached
+		conclusive = True
+		for term in search_terms(album, artist, clean_album):
+			response = self._get(self.search_url, params={'term': term, 'entity': 'album', 'limit': 1})
+			if response is None or response.status_code != 200:
+				conclusive = False
+				continue
+
+			try:
+				results = response.json()['results']
+			except (ValueError, KeyError):
+				conclusive = False
+				continue
+			if len(results) == 0 or 'artworkUrl100' not in results[0]:
+				continue
+
+			# the artwork comes from a CDN, only the search API is rate limited
+			artwork_url = results[0]['artworkUrl100']
+			image = self._get(artwork_url, throttle=False)
+			if image is None or image.status_code != 200:
+				conclusive = False
+				continue
+
+			# unique per writer, processes sharing the store may fetch the same cover at once
+			temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+			with open(temp_path, 'wb') as fp:
+				fp.write(image.content)
+			os.replace(temp_path, path)
+			return artwork_url, term
+
+		if not conclusive:
+			raise ArtLookupError(f'could not reach {self.search_url} for {album} by {artist}')
+		return None
+
+	def _try_fetch(self, album, artist, clean_album, path):
+		try:
+			return 'found', self.fetch(album, artist, clean_album, path)
+		except ArtLookupError as e:
+			return 'error', str(e)
+
+	def fetch_all(self, albums):
+		# albums are (album, artist, clean_album) tuples, returns {(album, artist): path} for the ones with art.
+		# the index answers everything it has seen, only new albums and expired misses hit the network
+		if not os.path.exists(self.album_art_dir):
+			os.makedirs(self.album_art_dir)
+		index = AlbumArtIndex(os.path.join(self.album_art_dir, ART_INDEX_FILE))
+
+		art = {}
+		to_fetch = {}
+		num_missing = 0
+		for album, artist, clean_album in dict.fromkeys(albums):
+			key = art_key(album, artist, clean_album)
+			entry = index.get(key)
+			if entry is not None and entry['found'] and os.path.exists(os.path.join(self.album_art_dir, entry['path'])):
+				art[(album, artist)] = os.path.join(self.album_art_dir, entry['path'])
+			elif entry is not None and not entry['found'] and time.time() - entry['checked_at'] < ART_NEGATIVE_TTL:
+				num_missing += 1
+			else:
+				to_fetch.setdefault(key, []).append((album, artist, clean_album))
+
+		count('album_art_index_hits', len(art) + num_missing)
+		if num_missing > 0:
+			print(f'- {num_missing} albums had no art on an earlier run, not searching again yet')
+
+		keys = list(to_fetch)
+		with ThreadPoolExecutor(max_workers=self.workers) as executor:
+			results = list(executor.map(lambda key: self._try_fetch(*to_fetch[key][0], os.path.join(self.album_art_dir, art_file_name(key))), keys))
+
+		# the index is only touched from this thread
+		for key, (status, result) in zip(keys, results):
+			if status == 'error':
+				print(f'- {result}')
+			elif result is None:
+				index.put(key, False)
+			else:
+				artwork_url, query = result
+				index.put(key, True, artwork_url=artwork_url, path=art_file_name(key), query=query)
+				for album, artist, clean_album in to_fetch[key]:
+					art[(album, artist)] = os.path.join(self.album_art_dir, art_file_name(key))
+
+		index.close()
+		return art
@@ -0,0 +1,73 @@
+from src.tracing import traced
+import pandas as pd
+import numpy as np
+
+# entity columns each chart kind groups on
+CUBE_KINDS = {
+	'artist': ['artist'],
+	'track': ['track', 'artist'],
+	'album': ['album', 'artist'],
+	'podcast': ['podcast'],
+}
+PODCAST_KINDS = ['podcast']
+# normalized titles ride along with their entity, they are a function of it so no extra rows
+CUBE_ATTRIBUTES = {'track': ['track_clean'], 'album': ['album_clean']}
+CUBE_TIME_COLUMNS = ['year', 'month', 'week']
+
+
+def iso_week_start(ts):
+	# monday of the ISO week each play falls in (1970-01-01 was a thursday)
+	days = ts.values.astype('datetime64[D]')
+	weekday = (days.astype(np.int64) + 3) % 7
+	return pd.Series(days - weekday.astype('timedelta64[D]'), index=ts.index)
+
+
+def aggregate_plays(df, entity_cols, attribute_cols=None):
+	attribute_cols = attribute_cols or []
+	plays = df[entity_cols + attribute_cols + ['year', 'month', 'ms_played']].copy()
+	plays['week'] = iso_week_start(df['ts'])
+
+	cube = plays.groupby(entity_cols + attribute_cols + CUBE_TIME_COLUMNS, observed=True, sort=False)['ms_played'].sum()
+	return cube.reset_index()
+
+
+@traced
+def build_listening_cube(df, podcasts_df):
+	print('- Aggregating listening history...')
+	cube = {}
+	for kind, entity_cols in CUBE_KINDS.items():
+		plays = podcasts_df if kind in PODCAST_KINDS else df
+		attribute_cols = [col for col in CUBE_ATTRIBUTES.get(kind, []) if col in plays.columns]
+		cube[kind] = aggregate_plays(plays, entity_cols, attribute_cols)
+
+	print()
+	return cube
+
+
+def top_entities(cube_df, entity_cols, top_n):
+	# partial selection over the per-entity totals, the plays are never sorted
+	totals = cube_df.groupby(entity_cols, observed=True)['ms_played'].sum()
+	return totals.nlargest(top_n)
+
+
+def entity_year_matrix(cube_df, entity_cols, entities, years):
+	# dense (entity x year) ms_played, cells nobody listened to are 0
+	first_values = [entity[0] for entity in entities] if len(entity_cols) > 1 else entities
+	cube_df = cube_df[cube_df[entity_cols[0]].isin(first_values)]
+
+	if len(entity_cols) > 1:
+		index = pd.MultiIndex.from_tuples(entities, names=entity_cols)
+		keys = pd.MultiIndex.from_frame(cube_df[entity_cols].astype(object))
+	else:
+		index = pd.Index(entities, name=entity_cols[0])
+		keys = cube_df[entity_cols[0]].astype(object)
+
+	rows = index.get_indexer(keys)
+	cols = pd.Index(years).get_indexer(cube_df['year'])
+	in_matrix = (rows >= 0) & (cols >= 0)
+
+	# scatter every cube row into its cell in one pass
+	cells = rows[in_matrix] * len(years) + cols[in_matrix]
+	values = np.bincount(cells, weights=cube_df['ms_played'].values[in_matrix], minlength=len(index) * len(years))
+
+	return pd.DataFrame(values.reshape(len(index), len(years)).astype(np.int64), index=index, columns=pd.Index(list(years), name='year'))
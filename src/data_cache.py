@@ -0,0 +1,142 @@
+import pandas as pd
+import numpy as np
+import zipfile
+import json
+import os
+
+# bump whenever the cached columns or their encoding change
+CACHE_SCHEMA_VERSION = 4
+
+CACHE_FILES = {
+	'music': 'spotify_data.npz',
+	'podcasts': 'spotify_podcasts_data.npz',
+}
+
+
+def get_cache_paths(output_dir):
+	return {name: os.path.join(output_dir, filename) for name, filename in CACHE_FILES.items()}
+
+
+def _smallest_int_dtype(n):
+	for dtype in (np.int8, np.int16, np.int32):
+		if n < np.iinfo(dtype).max:
+			return dtype
+	return np.int64
+
+
+def _encode_column(col, key, arrays):
+	dtype = col.dtype
+
+	if pd.api.types.is_datetime64_any_dtype(dtype):
+		tz = getattr(dtype, 'tz', None)
+		# numpy always holds the naive UTC wall time, tz is restored on load
+		arrays[key] = col.values
+		return {'kind': 'datetime', 'tz': None if tz is None else str(tz)}
+
+	if isinstance(dtype, np.dtype) and dtype.kind in 'biuf':
+		arrays[key] = col.values
+		return {'kind': 'numeric'}
+
+	# everything else (strings, mixed objects, categoricals) is stored as int codes + a vocabulary
+	if isinstance(dtype, pd.CategoricalDtype):
+		codes = col.cat.codes.values
+		vocab = col.cat.categories
+		ordered = bool(dtype.ordered)
+	else:
+		codes, vocab = pd.factorize(col)
+		ordered = False
+
+	arrays[key] = codes.astype(_smallest_int_dtype(len(vocab)))
+
+	vocab = list(vocab)
+	info = {'kind': 'codes', 'dtype': str(dtype), 'ordered': ordered}
+	if all(isinstance(x, str) for x in vocab):
+		arrays[f'{key}_vocab'] = np.array(vocab, dtype=str)
+	else:
+		# small non-string vocabularies (e.g. nullable booleans) go in the header
+		info['vocab'] = [x.item() if isinstance(x, np.generic) else x for x in vocab]
+	return info
+
+
+def _decode_column(info, key, data):
+	values = data[key]
+
+	if info['kind'] == 'datetime':
+		col = pd.Series(values)
+		if info['tz'] is not None:
+			col = col.dt.tz_localize('UTC').dt.tz_convert(info['tz'])
+		return col
+
+	if info['kind'] == 'numeric':
+		return pd.Series(values)
+
+	if 'vocab' in info:
+		vocab = info['vocab']
+	else:
+		vocab = data[f'{key}_vocab'].astype(object)
+
+	col = pd.Series(pd.Categorical.from_codes(values, categories=vocab, ordered=info['ordered']))
+	if info['dtype'] != 'category':
+		col = col.astype(info['dtype'])
+	return col
+
+
+def write_frame(df, path):
+	df = df.reset_index(drop=True)
+
+	arrays = {}
+	columns = []
+	for i, name in enumerate(df.columns):
+		info = _encode_column(df[name], f'c{i}', arrays)
+		info['name'] = name
+		columns.append(info)
+
+	meta = {
+		'schema_version': CACHE_SCHEMA_VERSION,
+		'num_rows': len(df),
+		'columns': columns,
+	}
+	arrays['meta'] = np.frombuffer(json.dumps(meta).encode('utf-8'), dtype=np.uint8)
+
+	# write next to the target and swap in, so an interrupted run never leaves half a cache behind
+	temp_path = f'{path}.tmp'
+	with open(temp_path, 'wb') as fp:
+		np.savez(fp, **arrays)
+	os.replace(temp_path, path)
+
+
+def read_frame(path):
+	with np.load(path, allow_pickle=False) as data:
+		meta = json.loads(data['meta'].tobytes().decode('utf-8'))
+
+		if meta.get('schema_version') != CACHE_SCHEMA_VERSION:
+			return None
+
+		df = pd.DataFrame({info['name']: _decode_column(info, f'c{i}', data) for i, info in enumerate(meta['columns'])})
+
+	return df
+
+
+def save_cache(output_dir, df, podcasts_df):
+	paths = get_cache_paths(output_dir)
+	write_frame(df, paths['music'])
+	write_frame(podcasts_df, paths['podcasts'])
+
+
+def load_cache(output_dir):
+	paths = get_cache_paths(output_dir)
+	if not all(os.path.exists(path) for path in paths.values()):
+		return None
+
+	try:
+		df = read_frame(paths['music'])
+		podcasts_df = read_frame(paths['podcasts'])
+	except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+		print('- Cache is unreadable, ignoring it')
+		return None
+
+	if df is None or podcasts_df is None:
+		print('- Cache was written by an older version, ignoring it')
+		return None
+
+	return df, podcasts_df
@@ -0,0 +1,93 @@
+import pandas as pd
+import numpy as np
+import json
+import os
+import re
+
+# high-cardinality name columns, stored as categoricals so groupbys run on integer codes
+ENTITY_COLUMNS = ['artist', 'album', 'track', 'podcast', 'episode']
+
+# title columns that get a normalized *_clean twin, e.g. 'Song - Remastered 2011' and 'Album (Deluxe)' -> 'Song', 'Album'
+TITLE_COLUMNS = ['track', 'album']
+CLEAN_TITLE_COLUMNS = [f'{col}_clean' for col in TITLE_COLUMNS]
+TITLE_MEMO_FILE = 'spotify_titles.json'
+# bump when normalize_title changes, old memos are thrown away
+TITLE_MEMO_SCHEMA_VERSION = 1
+
+
+def encode_entities(df):
+	for col in ENTITY_COLUMNS:
+		if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+			df[col] = df[col].astype('category')
+	return df
+
+
+def remap_categories(col, mapping):
+	# rewrite the vocabulary instead of every row, categories that end up equal are merged
+	categories = col.cat.categories
+	if callable(mapping):
+		new_values = [mapping(x) for x in categories]
+	else:
+		new_values = [mapping.get(x, x) for x in categories]
+
+	new_categories = pd.Index(new_values).unique()
+	old_to_new = new_categories.get_indexer(new_values)
+
+	codes = col.cat.codes.values
+	new_codes = np.where(codes >= 0, old_to_new[codes], -1)
+	return pd.Series(pd.Categorical.from_codes(new_codes, categories=new_categories), index=col.index, name=col.name)
+
+
+def concat_frames(frames):
+	# give every frame the same vocabulary first, otherwise pd.concat falls back to object columns
+	frames = list(frames)
+	for col in ENTITY_COLUMNS + CLEAN_TITLE_COLUMNS:
+		parts = [df[col] for df in frames if col in df.columns]
+		if len(parts) < 2 or not all(isinstance(part.dtype, pd.CategoricalDtype) for part in parts):
+			continue
+
+		categories = pd.Index(np.concatenate([part.cat.categories.values for part in parts])).unique()
+		frames = [df.assign(**{col: df[col].cat.set_categories(categories)}) if col in df.columns else df for df in frames]
+
+	return pd.concat(frames, ignore_index=True)
+
+
+def normalize_title(title):
+	return re.sub(r' \(.+\)', '', re.sub(r' -.*', '', title))
+
+
+def add_clean_titles(df, memo):
+	# the regexes only ever see the vocabulary, and only titles the memo has not seen before
+	def lookup(title):
+		if title not in memo:
+			memo[title] = normalize_title(title)
+		return memo[title]
+
+	for col in TITLE_COLUMNS:
+		if col in df.columns:
+			df[f'{col}_clean'] = remap_categories(df[col], lookup)
+	return df
+
+
+def load_title_memo(output_dir):
+	path = os.path.join(output_dir, TITLE_MEMO_FILE)
+	if not os.path.exists(path):
+		return {}
+
+	try:
+		with open(path, 'r', encoding='utf-8') as fp:
+			memo = json.load(fp)
+	except (OSError, ValueError):
+		return {}
+
+	if memo.get('schema_version') != TITLE_MEMO_SCHEMA_VERSION:
+		return {}
+	return memo['titles']
+
+
+def save_title_memo(output_dir, titles):
+	path = os.path.join(output_dir, TITLE_MEMO_FILE)
+	temp_path = f'{path}.tmp'
+	with open(temp_path, 'w', encoding='utf-8') as fp:
+		json.dump({'schema_version': TITLE_MEMO_SCHEMA_VERSION, 'titles': titles}, fp, ensure_ascii=False, sort_keys=True)
+	os.replace(temp_path, path)
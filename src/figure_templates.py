@@ -0,0 +1,32 @@
+from src.lazy_imports import lazy_import
+
+backend_agg = lazy_import('matplotlib.backends.backend_agg')
+mfigure = lazy_import('matplotlib.figure')
+
+SUBPLOT_PARAMS = ['left', 'right', 'bottom', 'top', 'wspace', 'hspace']
+
+# figure skeletons of this process, keyed by chart kind and style
+_templates = {}
+
+
+def get_figure_template(key, figsize, build):
+	# build(ax) draws what every chart of the kind shares (grid, axis labels, spines). the figure lives
+	# outside pyplot so closing a chart's figures keeps it, every use starts from an empty plot area
+	if key not in _templates:
+		fig = mfigure.Figure(figsize=figsize)
+		backend_agg.FigureCanvasAgg(fig)
+		ax = fig.subplots()
+		build(ax)
+		_templates[key] = (fig, ax, {name: getattr(fig.subplotpars, name) for name in SUBPLOT_PARAMS})
+
+	fig, ax, subplot_params = _templates[key]
+	for container in list(ax.containers):
+		container.remove()
+	for patch in list(ax.patches):
+		patch.remove()
+	ax.relim()
+
+	# tight_layout starts from the default margins, as it does on a new figure
+	fig.subplots_adjust(**subplot_params)
+	fig.set_size_inches(figsize)
+	return fig, ax
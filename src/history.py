@@ -0,0 +1,153 @@
+from src.cube import CUBE_KINDS, PODCAST_KINDS, CUBE_ATTRIBUTES, aggregate_plays, top_entities
+from src.rolling import rolling_top_k
+from collections import OrderedDict
+from src.tracing import traced
+import pandas as pd
+import threading
+
+# memoized aggregates are evicted least recently used first, past either limit
+MEMO_MAX_ENTRIES = 64
+MEMO_MAX_BYTES = 512 * 2 ** 20
+
+TIMESERIES_FREQS = ['W', 'M', 'Y']
+MS_PER_HOUR = 3600000
+
+
+def _nbytes(value):
+	if isinstance(value, pd.DataFrame):
+		return int(value.memory_usage(index=True).sum())
+	if isinstance(value, pd.Series):
+		return int(value.memory_usage(index=True))
+	return 0
+
+
+class SpotifyHistory:
+	# queries over the plays load_data returns. aggregates are computed on first use and memoized,
+	# history[kind] is a copy of the listening cube of a kind so the chart planners can take the object as their cube
+	def __init__(self, df, podcasts_df, max_entries=MEMO_MAX_ENTRIES, max_bytes=MEMO_MAX_BYTES):
+		self.df = df
+		self.podcasts_df = podcasts_df
+		self.max_entries = max_entries
+		self.max_bytes = max_bytes
+		self.memo = OrderedDict()
+		self.memo_bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.Lock()
+
+	def _memoized(self, key, compute):
+		with self.lock:
+			if key in self.memo:
+				self.memo.move_to_end(key)
+				self.hits += 1
+				return self.memo[key][0]
+
+		# computed outside the lock, two threads asking for the same aggregate at once both compute it
+		value = compute()
+		size = _nbytes(value)
+		with self.lock:
+			self.misses += 1
+			if key not in self.memo:
+				self.memo[key] = (value, size)
+				self.memo_bytes += size
+			while len(self.memo) > 1 and (len(self.memo) > self.max_entries or self.memo_bytes > self.max_bytes):
+				_, (_, evicted_size) = self.memo.popitem(last=False)
+				self.memo_bytes -= evicted_size
+		return value
+
+	def plays(self, kind):
+		self._check_kind(kind)
+		return self.podcasts_df if kind in PODCAST_KINDS else self.df
+
+	def _check_kind(self, kind):
+		if kind not in CUBE_KINDS:
+			raise ValueError(f'unknown kind {kind!r}, expected one of {list(CUBE_KINDS)}')
+
+	def _cube(self, kind):
+		# the memoized cube itself, only for the queries below, which don't modify it
+		def compute():
+			plays = self.plays(kind)
+			attribute_cols = [col for col in CUBE_ATTRIBUTES.get(kind, []) if col in plays.columns]
+			return aggregate_plays(plays, CUBE_KINDS[kind], attribute_cols)
+		return self._memoized(('cube', kind), compute)
+
+	def cube(self, kind):
+		# ms_played per (entity, year, month, week), see src/cube.py
+		return self._cube(kind).copy()
+
+	def __getitem__(self, kind):
+		return self.cube(kind)
+
+	def _range_totals(self, kind, start, end):
+		# plays with start <= ts < end, naive bounds are read in the timezone of the history
+		plays = self.plays(kind)
+		mask = pd.Series(True, index=plays.index)
+		for bound, keep in [(start, lambda ts, bound: ts >= bound), (end, lambda ts, bound: ts < bound)]:
+			if bound is not None:
+				bound = pd.Timestamp(bound)
+				if bound.tzinfo is None and plays['ts'].dt.tz is not None:
+					bound = bound.tz_localize(plays['ts'].dt.tz)
+				mask &= keep(plays['ts'], bound)
+		return plays[mask].groupby(CUBE_KINDS[kind], observed=True)['ms_played'].sum()
+
+	@traced
+	def top(self, kind, n=20, start=None, end=None):
+		# the n entities with the most hours, between start and end when given. track and album entities are (title, artist)
+		def compute():
+			if start is None and end is None:
+				totals = top_entities(self._cube(kind), CUBE_KINDS[kind], n)
+			else:
+				totals = self._range_totals(kind, start, end).nlargest(n)
+			top = (totals / MS_PER_HOUR).rename('hours_played').reset_index()
+			top[CUBE_KINDS[kind]] = top[CUBE_KINDS[kind]].astype(object)
+			return top
+		key = ('top', kind, n, None if start is None else str(start), None if end is None else str(end))
+		return self._memoized(key, compute).copy()
+
+	@traced
+	def by_year(self, kind):
+		# hours per entity (rows) and year (columns), every entity ever played
+		def compute():
+			totals = self._cube(kind).groupby(CUBE_KINDS[kind] + ['year'], observed=True)['ms_played'].sum()
+			return (totals.unstack('year', fill_value=0) / MS_PER_HOUR).sort_index(axis=1)
+		return self._memoized(('by_year', kind), compute).copy()
+
+	@traced
+	def timeseries(self, kind, freq='M', n=None):
+		# hours per period (rows) and entity (columns). freq is 'W' (weeks starting monday), 'M' or 'Y',
+		# n keeps only the top n entities of all time
+		if freq not in TIMESERIES_FREQS:
+			raise ValueError(f'unknown freq {freq!r}, expected one of {TIMESERIES_FREQS}')
+
+		def compute():
+			cube = self._cube(kind)
+			if n is not None:
+				entities = top_entities(cube, CUBE_KINDS[kind], n).index
+				keys = cube.set_index(CUBE_KINDS[kind]).index
+				cube = cube[keys.isin(entities)]
+
+			if freq == 'W':
+				period = pd.to_datetime(cube['week'])
+			elif freq == 'M':
+				period = pd.to_datetime(pd.DataFrame({'year': cube['year'], 'month': cube['month'], 'day': 1}))
+			else:
+				period = pd.to_datetime(pd.DataFrame({'year': cube['year'], 'month': 1, 'day': 1}))
+
+			totals = cube.groupby([period.rename('period')] + CUBE_KINDS[kind], observed=True)['ms_played'].sum()
+			series = totals.unstack(CUBE_KINDS[kind], fill_value=0) / MS_PER_HOUR
+			if n is not None:
+				# columns in rank order
+				series = series[[entity for entity in entities if entity in series.columns]]
+			return series
+		return self._memoized(('timeseries', kind, freq, n), compute).copy()
+
+	@traced
+	def rolling_top(self, kind, window_days=30, k=10, step_days=1):
+		# the top k entities of the window_days days up to each step, a row per (date, rank), see src/rolling.py
+		def compute():
+			return rolling_top_k(self.plays(kind), CUBE_KINDS[kind], window_days=window_days, k=k, step_days=step_days)
+		return self._memoized(('rolling_top', kind, window_days, k, step_days), compute).copy()
+
+	def memo_info(self):
+		with self.lock:
+			return {'entries': len(self.memo), 'bytes': self.memo_bytes, 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,224 @@
+from concurrent.futures import ProcessPoolExecutor
+from pandas.api.types import union_categoricals
+import pandas as pd
+import numpy as np
+import codecs
+import json
+import io
+import os
+import re
+
+VALID_FILE_PATTERN = r"Streaming_History.+\.json"
+
+# streaming mode only keeps the columns the charts need
+STREAM_MUSIC_COLUMNS = ['ts', 'ms_played', 'master_metadata_track_name', 'master_metadata_album_artist_name', 'master_metadata_album_album_name', 'spotify_track_uri']
+STREAM_PODCAST_COLUMNS = ['ts', 'ms_played', 'episode_name', 'episode_show_name', 'spotify_episode_uri']
+STREAM_CHUNK_SIZE = 100000
+STREAM_BLOCK_SIZE = 1 << 20
+# a record is a few hundred bytes, one still undecoded after this many blocks is malformed rather than long
+STREAM_MAX_RECORD_BLOCKS = 4
+
+RECORD_SEPARATOR = re.compile(r'[\s,]*')
+
+BOMS = [
+	(codecs.BOM_UTF32_LE, 'utf-32'),
+	(codecs.BOM_UTF32_BE, 'utf-32'),
+	(codecs.BOM_UTF8, 'utf-8-sig'),
+	(codecs.BOM_UTF16_LE, 'utf-16'),
+	(codecs.BOM_UTF16_BE, 'utf-16'),
+]
+
+
+def list_history_files(json_dir):
+	return [os.path.join(json_dir, f) for f in os.listdir(json_dir) if re.match(VALID_FILE_PATTERN, f)]
+
+
+def cast_bool_to_numeric(df):
+	bool_cols = df.select_dtypes(include=bool).columns
+	df[bool_cols] = df[bool_cols].astype(int)
+	return df
+
+
+def sniff_encoding(head):
+	for bom, encoding in BOMS:
+		if head.startswith(bom):
+			return encoding
+
+	# no BOM: an export always starts with '[' so a null byte next to it gives utf-16 away
+	if len(head) >= 2:
+		if head[0] == 0 and head[1] != 0:
+			return 'utf-16-be'
+		if head[0] != 0 and head[1] == 0:
+			return 'utf-16-le'
+
+	return 'utf-8'
+
+
+def decode_history_bytes(raw):
+	encoding = sniff_encoding(raw[:4])
+	try:
+		return raw.decode(encoding)
+	except UnicodeDecodeError:
+		# latin-1 maps every byte, so this never fails
+		return raw.decode('latin-1')
+
+
+def read_history_file(path):
+	with open(path, 'rb') as fp:
+		raw = fp.read()
+
+	text = decode_history_bytes(raw)
+	try:
+		df = pd.read_json(io.StringIO(text))
+	except ValueError:
+		return None
+
+	return cast_bool_to_numeric(df)
+
+
+def read_history_files(paths, jobs=None):
+	if jobs is None:
+		jobs = os.cpu_count() or 1
+	jobs = min(jobs, len(paths))
+
+	if jobs <= 1:
+		frames = [read_history_file(path) for path in paths]
+	else:
+		# map keeps the input order, so the result matches the serial path exactly
+		with ProcessPoolExecutor(max_workers=jobs) as executor:
+			frames = list(executor.map(read_history_file, paths))
+
+	valid_frames = []
+	for path, df in zip(paths, frames):
+		if df is None:
+			print(f'- Could not parse {os.path.basename(path)}, skipping')
+			continue
+		valid_frames.append(df)
+
+	return valid_frames
+
+
+def _iter_records(path, encoding, block_size):
+	decoder = json.JSONDecoder()
+	with open(path, 'r', encoding=encoding) as fp:
+		buffer = fp.read(block_size).lstrip()
+		if not buffer.startswith('['):
+			raise ValueError(f'{path} is not a json array')
+		pos = 1
+
+		while True:
+			pos = RECORD_SEPARATOR.match(buffer, pos).end()
+			if pos < len(buffer) and buffer[pos] == ']':
+				return
+
+			try:
+				record, pos = decoder.raw_decode(buffer, pos)
+			except json.JSONDecodeError:
+				# the record runs past the end of the buffer, pull in the next block and retry.
+				# a malformed record never decodes, give up before the buffer holds the whole file
+				if len(buffer) - pos >= STREAM_MAX_RECORD_BLOCKS * block_size:
+					raise ValueError(f'{path} has a malformed record')
+				more = fp.read(block_size)
+				if not more:
+					raise ValueError(f'{path} ends in the middle of a record')
+				buffer = buffer[pos:] + more
+				pos = 0
+				continue
+
+			yield record
+
+			# drop what has been consumed so the buffer stays around one block
+			if pos > block_size:
+				buffer = buffer[pos:]
+				pos = 0
+
+
+def iter_history_records(path, block_size=STREAM_BLOCK_SIZE):
+	with open(path, 'rb') as fp:
+		encoding = sniff_encoding(fp.read(4))
+
+	num_yielded = 0
+	try:
+		for record in _iter_records(path, encoding, block_size):
+			num_yielded += 1
+			yield record
+	except UnicodeDecodeError:
+		# same fallback as decode_history_bytes, skipping what was already handed out
+		for i, record in enumerate(_iter_records(path, 'latin-1', block_size)):
+			if i >= num_yielded:
+				yield record
+
+
+def _buffer_column(col, values):
+	if col == 'ts':
+		return pd.to_datetime(values, utc=True)
+	if col == 'ms_played':
+		return np.asarray(values, dtype=np.int64)
+	return pd.Categorical(values)
+
+
+def _flush_buffers(buffers, chunks):
+	if not buffers['ts']:
+		return
+
+	chunk = {}
+	for col, values in buffers.items():
+		chunk[col] = _buffer_column(col, values)
+		values.clear()
+
+	chunks.append(pd.DataFrame(chunk))
+
+
+def _concat_chunks(chunks, columns):
+	if not chunks:
+		# the same dtypes as a flushed chunk, so an empty side still merges with the cache
+		return pd.DataFrame({col: _buffer_column(col, []) for col in columns})
+
+	df = {}
+	for col in columns:
+		parts = [chunk[col] for chunk in chunks]
+		if isinstance(parts[0].dtype, pd.CategoricalDtype):
+			# one shared vocabulary across all chunks
+			df[col] = pd.Series(union_categoricals(parts))
+		else:
+			df[col] = pd.concat(parts, ignore_index=True)
+
+	return pd.DataFrame(df)
+
+
+def stream_history_files(paths, chunk_size=STREAM_CHUNK_SIZE):
+	music_buffers = {col: [] for col in STREAM_MUSIC_COLUMNS}
+	podcast_buffers = {col: [] for col in STREAM_PODCAST_COLUMNS}
+	music_chunks, podcast_chunks = [], []
+
+	for path in paths:
+		# a file is kept whole or not at all, same as read_history_files
+		num_music_chunks, num_podcast_chunks = len(music_chunks), len(podcast_chunks)
+		try:
+			for record in iter_history_records(path):
+				# same music/podcast split as format_df
+				if record.get('episode_name') is None:
+					buffers, chunks = music_buffers, music_chunks
+				else:
+					buffers, chunks = podcast_buffers, podcast_chunks
+
+				for col, values in buffers.items():
+					values.append(record.get(col))
+
+				if len(buffers['ts']) >= chunk_size:
+					_flush_buffers(buffers, chunks)
+		except ValueError:
+			print(f'- Could not parse {os.path.basename(path)}, skipping')
+			del music_chunks[num_music_chunks:], podcast_chunks[num_podcast_chunks:]
+			for values in list(music_buffers.values()) + list(podcast_buffers.values()):
+				values.clear()
+			continue
+
+		_flush_buffers(music_buffers, music_chunks)
+		_flush_buffers(podcast_buffers, podcast_chunks)
+
+	# None when not one of the files could be parsed, same as read_history_files
+	if not music_chunks and not podcast_chunks:
+		return None
+
+	return _concat_chunks(music_chunks, STREAM_MUSIC_COLUMNS), _concat_chunks(podcast_chunks, STREAM_PODCAST_COLUMNS)
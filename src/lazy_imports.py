@@ -0,0 +1,22 @@
+import importlib
+
+
+class LazyModule:
+	# stands in for a module until the first attribute lookup, which imports it for real
+	def __init__(self, name):
+		self._name = name
+		self._module = None
+
+	def __getattr__(self, attr):
+		if self._module is None:
+			self._module = importlib.import_module(self._name)
+		return getattr(self._module, attr)
+
+	def __repr__(self):
+		state = 'loaded' if self._module is not None else 'not loaded'
+		return f'<lazy module {self._name!r} ({state})>'
+
+
+def lazy_import(name):
+	# matplotlib, scipy, PIL and requests cost hundreds of ms to import, only pay for them when a chart is drawn
+	return LazyModule(name)
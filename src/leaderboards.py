@@ -0,0 +1,137 @@
+from src.plot_formatting import find_cleanest_columns, set_font, get_discrete_colors, get_axis_and_grid_colors, set_render_profile, DEFAULT_RENDER_PROFILE
+from src.scheduler import ChartJob, run_chart_jobs
+from src.tracing import traced, span
+from src.lazy_imports import lazy_import
+from src.cube import CUBE_KINDS
+import pandas as pd
+import os
+
+mdates = lazy_import('matplotlib.dates')
+plt = lazy_import('matplotlib.pyplot')
+
+LEADERBOARD_KINDS = ['artist', 'track', 'album', 'podcast']
+# (window_days, step_days) of the charts of one year and of the whole history
+YEAR_WINDOW = (30, 1)
+ALL_TIME_WINDOW = (90, 7)
+# entities that held a place the longest get a color and a legend entry, the rest are drawn in grey
+HIGHLIGHTED_ENTITIES = 10
+
+
+def create_leaderboard_charts(history, output_dir, top_n=10, darkmode=True, jobs=1, profile=DEFAULT_RENDER_PROFILE):
+	return run_chart_jobs(plan_leaderboard_charts(history, output_dir, top_n=top_n, darkmode=darkmode, profile=profile), jobs=jobs, output_dir=output_dir)
+
+
+def entity_labels(rankings, entity_cols):
+	if len(entity_cols) == 1:
+		return rankings[entity_cols[0]].astype(str)
+	return rankings[entity_cols[0]].astype(str) + ', ' + rankings[entity_cols[1]].astype(str)
+
+
+@traced
+def plan_leaderboard_charts(history, output_dir, top_n=10, darkmode=True, profile=DEFAULT_RENDER_PROFILE):
+	section = 'LEADERBOARDS'
+
+	chart_jobs = []
+	for kind in LEADERBOARD_KINDS:
+		if history.plays(kind).empty:
+			continue
+
+		kind_output_dir = os.path.join(output_dir, f'top_{kind}s')
+		if not os.path.exists(kind_output_dir):
+			os.makedirs(kind_output_dir)
+
+		# one pass over the whole history per window, every year's chart is a slice of it
+		# so the windows at the start of a year still count the end of the last one
+		rankings = history.rolling_top(kind, window_days=YEAR_WINDOW[0], k=top_n, step_days=YEAR_WINDOW[1])
+		rankings['label'] = entity_labels(rankings, CUBE_KINDS[kind])
+		rankings = rankings[['date', 'rank', 'label']]
+		if rankings.empty:
+			continue
+		years = sorted(rankings['date'].dt.year.unique())
+		for year in years:
+			year_path = os.path.join(kind_output_dir, f'leaderboard_top_{kind}s_{year}.png')
+			year_rankings = rankings[rankings['date'].dt.year == year]
+			chart_jobs.append(ChartJob(section, year_path, leaderboard_chart, (year_rankings, year_path, (year, year), YEAR_WINDOW[0]), {'kind': kind, 'top_n': top_n, 'darkmode': darkmode, 'profile': profile}))
+
+		all_time_rankings = history.rolling_top(kind, window_days=ALL_TIME_WINDOW[0], k=top_n, step_days=ALL_TIME_WINDOW[1])
+		all_time_rankings['label'] = entity_labels(all_time_rankings, CUBE_KINDS[kind])
+		all_time_path = os.path.join(kind_output_dir, f'leaderboard_top_{kind}s_{years[0]}-{years[-1]}.png')
+		chart_jobs.append(ChartJob(section, all_time_path, leaderboard_chart, (all_time_rankings[['date', 'rank', 'label']], all_time_path, (years[0], years[-1]), ALL_TIME_WINDOW[0]), {'kind': kind, 'top_n': top_n, 'darkmode': darkmode, 'profile': profile}))
+
+	return chart_jobs
+
+
+def leaderboard_chart(rankings, output_path, years, window_days, kind, top_n=10, darkmode=True, profile=DEFAULT_RENDER_PROFILE):
+	colors = get_discrete_colors()
+	axis_color, grid_color = get_axis_and_grid_colors()
+
+	if darkmode:
+		title_color = "white"
+		plt.style.use('dark_background')
+	else:
+		title_color = axis_color
+		plt.style.use('default')
+
+	print(f"- Creating top {top_n} {kind}s leaderboard at {output_path}...")
+
+	padding_amount = 20
+
+	plt.rcParams['font.family'] = set_font()
+	render_profile = set_render_profile(profile)
+
+	golden_ratio = (1 + 5 ** 0.5) / 2
+	height = 10
+	fig, ax = plt.subplots(figsize=(height*golden_ratio, height))
+	ax.grid(True, axis='y', color=grid_color, linewidth=1, zorder=-999, linestyle='--')
+
+	# rank per step (rows) and entity (columns), NaN while the entity is off the board so its line breaks there
+	ranks = rankings.pivot_table(index='date', columns='label', values='rank', aggfunc='min')
+	ranks = ranks.reindex(pd.Index(sorted(rankings['date'].unique()), name='date'))
+
+	# the longest and highest reigns first: a step at #1 counts top_n, a step at #top_n counts 1
+	standing = (top_n + 1 - ranks).sum().sort_values(ascending=False, kind='stable')
+	highlighted = list(standing.index[:HIGHLIGHTED_ENTITIES])
+
+	for label in standing.index[HIGHLIGHTED_ENTITIES:]:
+		ax.plot(ranks.index, ranks[label], color=axis_color, alpha=0.4, linewidth=1, zorder=1)
+	for i, label in reversed(list(enumerate(highlighted))):
+		ax.plot(ranks.index, ranks[label], color=colors[i], linewidth=2.5, label=label, zorder=999 - i)
+
+	ax.set_ylim(top_n + 0.5, 0.5)
+	ax.set_yticks(range(1, top_n + 1))
+	ax.set_yticklabels([f'#{rank}' for rank in range(1, top_n + 1)])
+	ax.set_xlim(ranks.index[0], ranks.index[-1])
+
+	min_year, max_year = years
+	if min_year == max_year:
+		ax.xaxis.set_major_locator(mdates.MonthLocator())
+		ax.xaxis.set_major_formatter(mdates.DateFormatter('%b'))
+		title = f'Top {top_n} {kind.capitalize()}s Leaderboard {min_year} ({window_days}-Day Windows)'
+	else:
+		ax.xaxis.set_major_locator(mdates.YearLocator())
+		ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y'))
+		ax.xaxis.set_minor_locator(mdates.MonthLocator(bymonth=[1, 4, 7, 10]))
+		title = f'Top {top_n} {kind.capitalize()}s Leaderboard {min_year}-{max_year} ({window_days}-Day Windows)'
+
+	ax.set_title(title, fontsize=20, fontweight='bold', color=title_color, pad=padding_amount)
+	ax.set_ylabel('Rank', fontsize=16, fontweight='bold', color=axis_color, labelpad=padding_amount)
+	ax.set_xlabel('Last Day of the Window', fontsize=16, fontweight='bold', color=axis_color, labelpad=padding_amount)
+
+	# Add legend in rank of the standing
+	handles, labels = ax.get_legend_handles_labels()
+	handles.reverse()
+	labels.reverse()
+	ax.legend(handles, labels, loc='center', bbox_to_anchor=(0.5, -0.2), borderaxespad=0., frameon=False, ncol=find_cleanest_columns(len(labels)))
+
+	# Set spines
+	ax.spines['left'].set_zorder(1000)
+	ax.spines['top'].set_visible(False)
+	ax.spines['right'].set_visible(False)
+	ax.spines['bottom'].set_visible(False)
+	ax.spines['left'].set_visible(True)
+
+	# Save figure
+	with span('layout'):
+		fig.tight_layout()
+	with span('savefig'):
+		fig.savefig(output_path, dpi=render_profile['dpi'], bbox_inches='tight')
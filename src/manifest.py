@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+
+MANIFEST_FILE = 'spotify_manifest.json'
+MANIFEST_SCHEMA_VERSION = 1
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def hash_file(path):
+	sha1 = hashlib.sha1()
+	with open(path, 'rb') as fp:
+		for block in iter(lambda: fp.read(HASH_BLOCK_SIZE), b''):
+			sha1.update(block)
+	return sha1.hexdigest()
+
+
+def load_manifest(output_dir):
+	path = os.path.join(output_dir, MANIFEST_FILE)
+	if not os.path.exists(path):
+		return {}
+
+	try:
+		with open(path, 'r') as fp:
+			manifest = json.load(fp)
+	except (OSError, ValueError):
+		return {}
+
+	if manifest.get('schema_version') != MANIFEST_SCHEMA_VERSION:
+		return {}
+	return manifest['files']
+
+
+def save_manifest(output_dir, files):
+	path = os.path.join(output_dir, MANIFEST_FILE)
+	temp_path = f'{path}.tmp'
+	with open(temp_path, 'w') as fp:
+		json.dump({'schema_version': MANIFEST_SCHEMA_VERSION, 'files': files}, fp, indent=2, sort_keys=True)
+	os.replace(temp_path, path)
+
+
+def scan_history_files(paths, previous):
+	files = {}
+	changes = {'new': [], 'changed': [], 'unchanged': [], 'removed': []}
+
+	for path in paths:
+		name = os.path.basename(path)
+		stat = os.stat(path)
+		entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+		old_entry = previous.get(name)
+
+		if old_entry is not None and old_entry['size'] == entry['size'] and old_entry['mtime_ns'] == entry['mtime_ns']:
+			# size and mtime match, trust the stored hash instead of re-reading the file
+			entry['sha1'] = old_entry['sha1']
+		else:
+			entry['sha1'] = hash_file(path)
+
+		if old_entry is None:
+			changes['new'].append(path)
+		elif old_entry['sha1'] != entry['sha1']:
+			changes['changed'].append(path)
+		else:
+			changes['unchanged'].append(path)
+
+		files[name] = entry
+
+	# removed files keep their entry, their plays stay in the cache until a rebuild
+	changes['removed'] = sorted(name for name in previous if name not in files)
+	for name in changes['removed']:
+		files[name] = previous[name]
+
+	return files, changes
+
+
+def print_manifest_report(changes):
+	counts = ', '.join(f'{len(changes[kind])} {kind}' for kind in ['new', 'changed', 'unchanged', 'removed'])
+	print(f'- Input files: {counts}')
+
+	for kind in ['new', 'changed']:
+		for path in changes[kind]:
+			print(f'  {kind}: {os.path.basename(path)}')
+	for name in changes['removed']:
+		print(f'  removed: {name} (its plays stay in the cache, use --rebuild to drop them)')
@@ -1,7 +1,39 @@
-from matplotlib import font_manager
-import matplotlib.ticker as mtick
-import matplotlib.pyplot as plt
-import matplotlib
+from src.lazy_imports import lazy_import
+import threading
+import os
+
+font_manager = lazy_import('matplotlib.font_manager')
+matplotlib = lazy_import('matplotlib')
+plt = lazy_import('matplotlib.pyplot')
+
+# resolved from the package, not the working directory
+FONT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Work_Sans')
+FONT_NAME = 'Work Sans'
+
+# named output qualities: savefig dpi (multi-year streamgraphs and album charts have their own),
+# antialiasing, streamgraph samples per output pixel and album cover size in pixels
+RENDER_PROFILES = {
+	'draft': {'dpi': 72, 'multiyear_dpi': 50, 'album_dpi': 30, 'antialiased': False, 'stream_density': 0.25, 'thumbnail_size': 32},
+	'screen': {'dpi': 150, 'multiyear_dpi': 100, 'album_dpi': 60, 'antialiased': True, 'stream_density': 0.5, 'thumbnail_size': 64},
+	'print': {'dpi': 600, 'multiyear_dpi': 300, 'album_dpi': 100, 'antialiased': True, 'stream_density': 1.0, 'thumbnail_size': 100},
+}
+DEFAULT_RENDER_PROFILE = 'print'
+
+
+# fonts are registered with matplotlib once per process. forked chart workers inherit the registration,
+# spawned ones import this module fresh and register their own
+_fonts_registered = False
+_fonts_lock = threading.Lock()
+
+
+def register_fonts():
+	global _fonts_registered
+	with _fonts_lock:
+		if _fonts_registered:
+			return
+		for font in font_manager.findSystemFonts(fontpaths=FONT_DIR):
+			font_manager.fontManager.addfont(font)
+		_fonts_registered = True
 
 
 def format_hours(float_hours):
@@ -42,16 +74,8 @@ def get_discrete_colors():
 
 
 def set_font():
-	font_info = {
-		'dir': "Work_Sans",
-		'name': "Work Sans"
-	}
-
-	fonts = font_manager.findSystemFonts(fontpaths=font_info['dir'])
-	for font in fonts:
-		font_manager.fontManager.addfont(font)
-	fontname = font_info['name']
-	return fontname
+	register_fonts()
+	return FONT_NAME
 
 
 def set_plot():
@@ -61,12 +85,9 @@ def set_plot():
 	          "#c2a089", "#fdfdb8", "#dc523f", "#662d91", "#00a99d", "#ff7bac", "#ffca1c", "#8cc63f", "#4662eb",
 	          "#bdc6bc", "#d9e021", "#c2a089", "#fdfdb8"]
 
-	font_dir = '../Work_Sans'
-	fonts = font_manager.findSystemFonts(fontpaths=font_dir)
-	for font in fonts:
-		font_manager.fontManager.addfont(font)
+	register_fonts()
 
-	fontname = "Work Sans"
+	fontname = FONT_NAME
 	plt.rcParams['font.family'] = fontname
 
 	plt.legend(loc='center left',
@@ -127,3 +148,11 @@ def find_cleanest_columns(N):
 			best_columns = columns
 
 	return best_columns
+
+
+def set_render_profile(profile):
+	# call after plt.style.use, the styles reset antialiasing
+	render_profile = RENDER_PROFILES[profile]
+	for key in ['lines.antialiased', 'patch.antialiased', 'text.antialiased']:
+		plt.rcParams[key] = render_profile['antialiased']
+	return render_profile
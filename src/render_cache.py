@@ -0,0 +1,106 @@
+import pandas as pd
+import numpy as np
+import hashlib
+import json
+import sys
+import os
+
+RENDER_INDEX_FILE = 'spotify_render_index.json'
+RENDER_INDEX_SCHEMA_VERSION = 1
+
+# code shared between the render functions, a change here touches every chart that uses it
+SHARED_SOURCES = [os.path.join(os.path.dirname(os.path.abspath(__file__)), name) for name in ['plot_formatting.py', 'figure_templates.py', 'thumbnails.py']]
+
+# where a chart reads its files from, not what it draws. left out of the key with the output path,
+# so moving the directories doesn't make every chart stale
+UNKEYED_KWARGS = ['album_art_dir']
+
+_source_digests = {}
+
+
+def _source_digest(path):
+	if path not in _source_digests:
+		with open(path, 'rb') as fp:
+			_source_digests[path] = hashlib.sha1(fp.read()).hexdigest()
+	return _source_digests[path]
+
+
+def code_version(func):
+	# the render function's module plus the shared styling, hashed once per run
+	module_path = getattr(sys.modules.get(func.__module__), '__file__', None)
+	paths = SHARED_SOURCES + ([module_path] if module_path else [])
+
+	sha1 = hashlib.sha1(f'{func.__module__}.{func.__qualname__}'.encode())
+	for path in paths:
+		sha1.update(_source_digest(path).encode())
+	return sha1.hexdigest()
+
+
+def _update_digest(sha1, value):
+	if isinstance(value, (pd.DataFrame, pd.Series)):
+		# row hashes cover the values and the index, the header covers labels and dtypes
+		sha1.update(type(value).__name__.encode())
+		if isinstance(value, pd.DataFrame):
+			sha1.update(repr([(str(col), str(dtype)) for col, dtype in value.dtypes.items()]).encode())
+		else:
+			sha1.update(f'{value.name}:{value.dtype}'.encode())
+		sha1.update(repr(list(value.index.names)).encode())
+		sha1.update(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+	elif isinstance(value, np.ndarray):
+		sha1.update(f'{value.dtype}{value.shape}'.encode())
+		sha1.update(np.ascontiguousarray(value).tobytes())
+	elif isinstance(value, (list, tuple)):
+		sha1.update(f'{type(value).__name__}{len(value)}'.encode())
+		for item in value:
+			_update_digest(sha1, item)
+	elif isinstance(value, dict):
+		sha1.update(f'dict{len(value)}'.encode())
+		for key in sorted(value, key=repr):
+			_update_digest(sha1, key)
+			_update_digest(sha1, value[key])
+	else:
+		# np.int64(2020) and 2020 should hash the same
+		if isinstance(value, np.generic):
+			value = value.item()
+		sha1.update(repr(value).encode())
+
+
+def chart_key(job):
+	sha1 = hashlib.sha1(code_version(job.func).encode())
+	# the index is already keyed by the output path
+	_update_digest(sha1, [arg for arg in job.args if not (isinstance(arg, str) and arg == job.output_path)])
+	_update_digest(sha1, {name: value for name, value in job.kwargs.items() if name not in UNKEYED_KWARGS})
+	return sha1.hexdigest()
+
+
+def load_render_index(output_dir):
+	path = os.path.join(output_dir, RENDER_INDEX_FILE)
+	if not os.path.exists(path):
+		return {}
+
+	try:
+		with open(path, 'r') as fp:
+			index = json.load(fp)
+	except (OSError, ValueError):
+		return {}
+
+	if index.get('schema_version') != RENDER_INDEX_SCHEMA_VERSION:
+		return {}
+	return index['charts']
+
+
+def save_render_index(output_dir, charts):
+	path = os.path.join(output_dir, RENDER_INDEX_FILE)
+	temp_path = f'{path}.tmp'
+	with open(temp_path, 'w') as fp:
+		json.dump({'schema_version': RENDER_INDEX_SCHEMA_VERSION, 'charts': charts}, fp, indent=2, sort_keys=True)
+	os.replace(temp_path, path)
+
+
+def index_path(output_dir, output_path):
+	# relative paths keep the index valid if the output directory moves
+	return os.path.relpath(output_path, output_dir)
+
+
+def is_fresh(charts, output_dir, output_path, key):
+	return charts.get(index_path(output_dir, output_path)) == key and os.path.exists(output_path)
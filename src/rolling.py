@@ -0,0 +1,106 @@
+from src.tracing import traced
+import pandas as pd
+import numpy as np
+
+# window lengths in days the leaderboards are usually asked for
+ROLLING_WINDOWS = [7, 30, 90]
+MS_PER_HOUR = 3600000
+
+
+def entity_codes(plays, entity_cols):
+	# a dense code per distinct entity, -1 for plays missing one of the columns, and each column's values in code order
+	valid = np.ones(len(plays), dtype=bool)
+	keys = np.zeros(len(plays), dtype=np.int64)
+	levels = []
+	for col in entity_cols:
+		col_codes, col_values = pd.factorize(plays[col])
+		valid &= col_codes >= 0
+		keys = keys * len(col_values) + col_codes
+		levels.append(np.asarray(col_values, dtype=object))
+
+	codes = np.full(len(plays), -1, dtype=np.int64)
+	codes[valid], unique_keys = pd.factorize(keys[valid])
+
+	# unpack the mixed radix keys back into one value per column
+	values = []
+	for level in reversed(levels):
+		unique_keys, level_codes = np.divmod(unique_keys, len(level))
+		values.append(level[level_codes])
+	values.reverse()
+	return codes, values
+
+
+def daily_totals(days, codes, ms_played, num_entities):
+	# ms_played per (day, entity) that was played, in day then entity order
+	pairs, pair_keys = pd.factorize(days * num_entities + codes)
+	pair_ms = np.bincount(pairs, weights=ms_played, minlength=len(pair_keys))
+
+	order = np.argsort(pair_keys, kind='stable')
+	pair_keys = pair_keys[order]
+	# float sums of integer ms are exact far beyond any listening history
+	return pair_keys // num_entities, pair_keys % num_entities, pair_ms[order].round().astype(np.int64)
+
+
+@traced
+def rolling_top_k(plays, entity_cols, window_days=30, k=10, step_days=1):
+	# the top k entities by ms_played over the window_days days up to and including each step. steps are every
+	# step_days days back from the last day played. the totals are kept as the window slides: each day is added
+	# once when it enters and subtracted once when it leaves, and each step only ranks the entities in the window.
+	# returns a row per (step, rank) with the window's last day, the rank, the entity columns and hours_played
+	columns = ['date', 'rank'] + entity_cols + ['hours_played']
+	codes, values = entity_codes(plays, entity_cols)
+	valid = codes >= 0
+	if not valid.any():
+		return pd.DataFrame(columns=columns)
+
+	days = plays['ts'].values.astype('datetime64[D]').astype(np.int64)[valid]
+	first_day = days.min()
+	num_entities = len(values[0])
+	pair_days, pair_codes, pair_ms = daily_totals(days - first_day, codes[valid], plays['ms_played'].values[valid], num_entities)
+	num_days = pair_days[-1] + 1
+	day_starts = np.searchsorted(pair_days, np.arange(num_days + 1))
+
+	# the next (day, entity) row of the same entity. within a window [start, end) the rows whose next row is at
+	# or past end are the entity's last, so they list each entity in the window once without hashing
+	by_entity = np.argsort(pair_codes, kind='stable')
+	next_row = np.full(len(pair_codes), len(pair_codes))
+	same_entity = pair_codes[by_entity[1:]] == pair_codes[by_entity[:-1]]
+	next_row[by_entity[:-1][same_entity]] = by_entity[1:][same_entity]
+
+	steps = np.arange(num_days - 1, -1, -step_days)[::-1]
+	top_codes = np.full((len(steps), k), -1, dtype=np.int64)
+	top_ms = np.zeros((len(steps), k), dtype=np.int64)
+
+	# integer totals, so subtracting a day leaves exactly what adding it found
+	totals = np.zeros(num_entities, dtype=np.int64)
+	added = 0
+	removed = 0
+	for i, step in enumerate(steps):
+		# an entity appears at most once per day, so plain fancy indexing adds each row
+		while added <= step:
+			start, end = day_starts[added], day_starts[added + 1]
+			totals[pair_codes[start:end]] += pair_ms[start:end]
+			added += 1
+		while removed <= step - window_days:
+			start, end = day_starts[removed], day_starts[removed + 1]
+			totals[pair_codes[start:end]] -= pair_ms[start:end]
+			removed += 1
+
+		start, end = day_starts[removed], day_starts[step + 1]
+		in_window = pair_codes[start:end][next_row[start:end] >= end]
+		in_window = in_window[totals[in_window] > 0]
+		if len(in_window) > k:
+			in_window = in_window[np.argpartition(-totals[in_window], k - 1)[:k]]
+
+		# most played first, ties go to the entity played first
+		ranked = in_window[np.lexsort((in_window, -totals[in_window]))]
+		top_codes[i, :len(ranked)] = ranked
+		top_ms[i, :len(ranked)] = totals[ranked]
+
+	step_index, rank_index = np.nonzero(top_codes >= 0)
+	ranked_codes = top_codes[step_index, rank_index]
+	result = pd.DataFrame({'date': (steps[step_index] + first_day).astype('datetime64[D]').astype('datetime64[ns]'), 'rank': rank_index + 1})
+	for col, col_values in zip(entity_cols, values):
+		result[col] = col_values[ranked_codes]
+	result['hours_played'] = top_ms[step_index, rank_index] / MS_PER_HOUR
+	return result[columns]
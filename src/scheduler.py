@@ -0,0 +1,96 @@
+from src.render_cache import load_render_index, save_render_index, chart_key, index_path, is_fresh
+from src.tracing import traced, span, count, start_tracing, stop_tracing, trace_settings, merge_trace
+from concurrent.futures import ProcessPoolExecutor
+from src.lazy_imports import lazy_import
+from collections import namedtuple
+import contextlib
+import traceback
+import io
+import os
+
+plt = lazy_import('matplotlib.pyplot')
+
+# one chart (or chart set) to render: func(*args, **kwargs) writes output_path.
+# func must be a module level function and args should hold only the aggregates it needs, jobs are pickled to the workers.
+ChartJob = namedtuple('ChartJob', ['section', 'output_path', 'func', 'args', 'kwargs'])
+
+
+def run_chart_job(job, trace=None):
+	# capture everything the chart prints so the parent can replay it in submission order.
+	# worker processes get the parent's trace settings, trace their own job and send the events back
+	if trace is not None:
+		start_tracing(**trace)
+
+	output = io.StringIO()
+	ok = False
+	with contextlib.redirect_stdout(output), plt.rc_context(), span(job.func.__name__, output=os.path.basename(job.output_path)):
+		try:
+			job.func(*job.args, **job.kwargs)
+			ok = True
+		except Exception:
+			print(traceback.format_exc())
+			print(f'Error creating {job.output_path}')
+		finally:
+			plt.close('all')
+
+	count('charts_rendered' if ok else 'charts_failed')
+	exported = stop_tracing().export() if trace is not None else None
+	return ok, output.getvalue(), exported
+
+
+def print_chart_output(chart_jobs, results):
+	section = None
+	for job, (ok, output, exported) in zip(chart_jobs, results):
+		merge_trace(exported)
+		if job.section != section:
+			if section is not None:
+				print()
+			section = job.section
+			print(section)
+			print('-' * len(section))
+
+		print(output, end='')
+		yield job, ok
+
+	if section is not None:
+		print()
+
+
+@traced
+def run_chart_jobs(chart_jobs, jobs=None, output_dir=None):
+	# with an output_dir, charts whose inputs, parameters and code are unchanged since the last render are skipped.
+	# returns the number of charts that failed
+	if output_dir is not None:
+		charts = load_render_index(output_dir)
+		with span('chart_keys'):
+			keys = [chart_key(job) for job in chart_jobs]
+		stale = [(job, key) for job, key in zip(chart_jobs, keys) if not is_fresh(charts, output_dir, job.output_path, key)]
+		count('charts_skipped', len(chart_jobs) - len(stale))
+		if len(stale) < len(chart_jobs):
+			print(f'- {len(chart_jobs) - len(stale)} charts are up to date, rendering {len(stale)}')
+			print()
+		chart_jobs = [job for job, key in stale]
+		keys = {job.output_path: key for job, key in stale}
+
+	if jobs is None:
+		jobs = os.cpu_count() or 1
+	jobs = min(jobs, len(chart_jobs))
+
+	if jobs <= 1:
+		results = print_chart_output(chart_jobs, (run_chart_job(job) for job in chart_jobs))
+		rendered = [job for job, ok in results if ok]
+	else:
+		# workers only ever save figures, so they don't need an interactive backend
+		with ProcessPoolExecutor(max_workers=jobs, initializer=plt.switch_backend, initargs=('Agg',)) as executor:
+			futures = [executor.submit(run_chart_job, job, trace_settings()) for job in chart_jobs]
+			results = print_chart_output(chart_jobs, (future.result() for future in futures))
+			rendered = [job for job, ok in results if ok]
+
+	# failed charts keep their old key, so they are retried next run
+	if output_dir is not None and rendered:
+		charts = load_render_index(output_dir)
+		for job in rendered:
+			charts[index_path(output_dir, job.output_path)] = keys[job.output_path]
+		save_render_index(output_dir, charts)
+
+	return len(chart_jobs) - len(rendered)
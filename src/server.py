@@ -0,0 +1,310 @@
+from src.plot_formatting import DEFAULT_RENDER_PROFILE
+from concurrent.futures import ProcessPoolExecutor, Future
+from src.top_podcasts import plan_podcast_charts
+from src.leaderboards import plan_leaderboard_charts
+from src.streamgraphs import plan_streamgraphs
+from src.top_artists import plan_artist_charts
+from src.top_albums import plan_album_charts
+from src.top_tracks import plan_track_charts
+from src.lazy_imports import lazy_import
+from src.scheduler import run_chart_job
+from collections import OrderedDict
+import urllib.parse
+import http.server
+import traceback
+import threading
+import json
+import os
+import re
+
+plt = lazy_import('matplotlib.pyplot')
+
+SERVE_CACHE_BYTES = 128 * 2 ** 20
+# chart plans hold the aggregates of every year of a kind, a few dozen cover the usual parameters
+PLAN_MEMO_ENTRIES = 32
+MAX_TOP_N = 50
+
+# chart kind: (plan group, file name of one year, file name of all time, file name of the years side by side)
+CHART_KINDS = {
+	'artists': ('artists', 'top_artists_{year}.png', 'top_artists_all_time.png', 'top_artists_all_time_by_year.png'),
+	'tracks': ('tracks', 'top_tracks_{year}.png', 'top_tracks_all_time.png', 'top_tracks_all_time_by_year.png'),
+	'podcasts': ('podcasts', 'top_podcasts_{year}.png', 'top_podcasts_all_time.png', 'top_podcasts_all_time_by_year.png'),
+	'albums': ('albums', 'top_albums_{year}.png', 'top_albums_all_time.png', 'top_albums_full.png'),
+	'streamgraph_artists': ('streamgraphs', 'streamgraph_top_artists_{year}.png', r'streamgraph_top_artists_\d+-\d+\.png', None),
+	'streamgraph_tracks': ('streamgraphs', 'streamgraph_top_tracks_{year}.png', r'streamgraph_top_tracks_\d+-\d+\.png', None),
+	'streamgraph_albums': ('streamgraphs', 'streamgraph_top_albums_{year}.png', r'streamgraph_top_albums_\d+-\d+\.png', None),
+	'streamgraph_podcasts': ('podcast_streamgraphs', 'streamgraph_top_podcasts_{year}.png', r'streamgraph_top_podcasts_\d+-\d+\.png', None),
+	'leaderboard_artists': ('leaderboards', 'leaderboard_top_artists_{year}.png', r'leaderboard_top_artists_\d+-\d+\.png', None),
+	'leaderboard_tracks': ('leaderboards', 'leaderboard_top_tracks_{year}.png', r'leaderboard_top_tracks_\d+-\d+\.png', None),
+	'leaderboard_albums': ('leaderboards', 'leaderboard_top_albums_{year}.png', r'leaderboard_top_albums_\d+-\d+\.png', None),
+	'leaderboard_podcasts': ('leaderboards', 'leaderboard_top_podcasts_{year}.png', r'leaderboard_top_podcasts_\d+-\d+\.png', None),
+}
+# year values that are not a year
+ALL_TIME = 'all'
+BY_YEAR = 'by_year'
+
+
+class ChartNotFound(Exception):
+	pass
+
+
+class RenderError(Exception):
+	pass
+
+
+class PngCache:
+	# rendered charts, least recently used dropped first once they add up to more than max_bytes.
+	# concurrent requests for a chart that is being rendered wait for that render instead of starting another
+	def __init__(self, max_bytes=SERVE_CACHE_BYTES):
+		self.max_bytes = max_bytes
+		self.pngs = OrderedDict()
+		self.num_bytes = 0
+		self.in_flight = {}
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.coalesced = 0
+
+	def put(self, key, png):
+		with self.lock:
+			self._put(key, png)
+
+	def _put(self, key, png):
+		if key in self.pngs:
+			self.num_bytes -= len(self.pngs.pop(key))
+		self.pngs[key] = png
+		self.num_bytes += len(png)
+		while len(self.pngs) > 1 and self.num_bytes > self.max_bytes:
+			_, evicted = self.pngs.popitem(last=False)
+			self.num_bytes -= len(evicted)
+
+	def get(self, key, render):
+		with self.lock:
+			if key in self.pngs:
+				self.pngs.move_to_end(key)
+				self.hits += 1
+				return self.pngs[key]
+
+			future = self.in_flight.get(key)
+			owner = future is None
+			if owner:
+				future = Future()
+				self.in_flight[key] = future
+				self.misses += 1
+			else:
+				self.coalesced += 1
+
+		if not owner:
+			return future.result()
+
+		try:
+			png = render()
+		except Exception as e:
+			with self.lock:
+				del self.in_flight[key]
+			future.set_exception(e)
+			raise
+
+		# cached before the in-flight entry goes, so a request in between finds one or the other
+		with self.lock:
+			self._put(key, png)
+			del self.in_flight[key]
+		future.set_result(png)
+		return png
+
+	def info(self):
+		with self.lock:
+			return {'charts': len(self.pngs), 'bytes': self.num_bytes, 'max_bytes': self.max_bytes,
+			        'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced}
+
+
+class ChartServer:
+	# renders the charts of one history on request. plans are memoized per (group, top_n, darkmode),
+	# rendering happens in worker processes so requests don't share pyplot state
+	def __init__(self, history, output_dir, jobs=1, cache_bytes=SERVE_CACHE_BYTES, profile=DEFAULT_RENDER_PROFILE):
+		self.history = history
+		self.output_dir = output_dir
+		self.profile = profile
+		self.album_art_dir = os.path.join(output_dir, 'album_art_dir')
+		self.cache = PngCache(cache_bytes)
+		self.plans = OrderedDict()
+		self.plans_in_flight = {}
+		self.plan_lock = threading.Lock()
+		self.executor = ProcessPoolExecutor(max_workers=jobs, initializer=plt.switch_backend, initargs=('Agg',))
+		self.years = sorted(int(year) for year in history['artist']['year'].unique())
+
+	def close(self):
+		self.executor.shutdown()
+
+	def _plan_group(self, group, top_n, darkmode):
+		variant_dir = os.path.join(self.output_dir, f"{group}_{top_n}_{'dark' if darkmode else 'light'}")
+		# the planners' progress lines go to the server log
+		if group == 'artists':
+			return plan_artist_charts(self.history['artist'], variant_dir, top_n=top_n, darkmode=darkmode, profile=self.profile)
+		if group == 'tracks':
+			return plan_track_charts(self.history['track'], variant_dir, top_n=top_n, darkmode=darkmode, profile=self.profile)
+		if group == 'podcasts':
+			return plan_podcast_charts(self.history['podcast'], variant_dir, top_n=top_n, darkmode=darkmode, profile=self.profile)
+		if group == 'albums':
+			return plan_album_charts(self.history['album'], variant_dir, top_n=top_n, album_art_dir=self.album_art_dir, profile=self.profile)
+		if group == 'leaderboards':
+			return plan_leaderboard_charts(self.history, variant_dir, top_n=top_n, darkmode=darkmode, profile=self.profile)
+		return plan_streamgraphs(self.history, variant_dir, top_n=top_n, darkmode=darkmode, podcasts=group == 'podcast_streamgraphs', profile=self.profile)
+
+	def plan(self, group, top_n, darkmode):
+		# {file name: job} of every chart of the group. planned outside the lock so one slow plan doesn't hold up
+		# the others, requests for a plan that is being made wait for it like PngCache does for renders
+		key = (group, top_n, darkmode)
+		with self.plan_lock:
+			if key in self.plans:
+				self.plans.move_to_end(key)
+				return self.plans[key]
+
+			future = self.plans_in_flight.get(key)
+			owner = future is None
+			if owner:
+				future = Future()
+				self.plans_in_flight[key] = future
+
+		if not owner:
+			return future.result()
+
+		try:
+			jobs = {os.path.basename(job.output_path): job for job in self._plan_group(group, top_n, darkmode)}
+		except Exception as e:
+			with self.plan_lock:
+				del self.plans_in_flight[key]
+			future.set_exception(e)
+			raise
+
+		with self.plan_lock:
+			self.plans[key] = jobs
+			if len(self.plans) > PLAN_MEMO_ENTRIES:
+				self.plans.popitem(last=False)
+			del self.plans_in_flight[key]
+		future.set_result(jobs)
+		return jobs
+
+	def find_job(self, kind, year, top_n, darkmode):
+		group, year_name, all_time_name, by_year_name = CHART_KINDS[kind]
+		# albums only come in light mode
+		darkmode = darkmode if group != 'albums' else False
+		jobs = self.plan(group, top_n, darkmode)
+
+		if year == ALL_TIME:
+			names = [name for name in jobs if re.fullmatch(all_time_name, name)]
+		elif year == BY_YEAR and by_year_name is not None:
+			names = [by_year_name]
+		else:
+			names = [year_name.format(year=year)]
+
+		if not names or names[0] not in jobs:
+			raise ChartNotFound(f'no {kind} chart for {year}')
+		return jobs[names[0]], names[0]
+
+	def render(self, kind, year=ALL_TIME, top_n=20, darkmode=True):
+		if kind not in CHART_KINDS:
+			raise ChartNotFound(f'unknown chart kind {kind}, expected one of {list(CHART_KINDS)}')
+		group = CHART_KINDS[kind][0]
+		key = (kind, str(year), top_n, darkmode if group != 'albums' else False)
+		return self.cache.get(key, lambda: self._render(kind, year, top_n, darkmode))
+
+	def _run(self, job):
+		ok, output, _ = self.executor.submit(run_chart_job, job).result()
+		if not ok:
+			raise RenderError(output)
+
+	def _render(self, kind, year, top_n, darkmode):
+		job, name = self.find_job(kind, year, top_n, darkmode)
+		self._run(job)
+		return self._take_png(job.output_path)
+
+	def _take_png(self, path):
+		# the disk copy is only a hand-off from the worker, the cache is what keeps charts around
+		with open(path, 'rb') as fp:
+			png = fp.read()
+		os.remove(path)
+		return png
+
+	def index(self):
+		return {
+			'kinds': list(CHART_KINDS),
+			'years': [ALL_TIME, BY_YEAR] + self.years,
+			'url': '/charts/<kind>.png?year=<year>&top_n=<n>&darkmode=<0|1>',
+			'max_top_n': MAX_TOP_N,
+			'cache': self.cache.info(),
+		}
+
+
+def parse_chart_request(path):
+	# /charts/<kind>.png?year=2020&top_n=10&darkmode=0 -> (kind, year, top_n, darkmode)
+	url = urllib.parse.urlparse(path)
+	match = re.fullmatch(r'/charts/([a-z_]+)\.png', url.path)
+	if match is None:
+		raise ChartNotFound(f'no chart at {url.path}')
+	query = urllib.parse.parse_qs(url.query)
+
+	year = query.get('year', [ALL_TIME])[0]
+	if year not in (ALL_TIME, BY_YEAR) and not year.isdigit():
+		raise ValueError(f'year must be a year, {ALL_TIME} or {BY_YEAR}, not {year}')
+
+	top_n = int(query.get('top_n', ['10'])[0])
+	if not 1 <= top_n <= MAX_TOP_N:
+		raise ValueError(f'top_n must be between 1 and {MAX_TOP_N}')
+
+	darkmode = query.get('darkmode', ['1'])[0].lower() not in ('0', 'false', 'no')
+	return match.group(1), year, top_n, darkmode
+
+
+class ChartRequestHandler(http.server.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+	chart_server = None
+
+	def log_message(self, format, *args):
+		print(f'- {self.address_string()} {format % args}')
+
+	def _send(self, status, body, content_type):
+		self.send_response(status)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', str(len(body)))
+		if status == 200 and content_type == 'image/png':
+			self.send_header('Cache-Control', 'max-age=3600')
+		self.end_headers()
+		self.wfile.write(body)
+
+	def _send_error(self, status, message):
+		self._send(status, json.dumps({'error': message}).encode(), 'application/json')
+
+	def do_GET(self):
+		if urllib.parse.urlparse(self.path).path in ('/', '/charts'):
+			self._send(200, json.dumps(self.chart_server.index(), indent=2).encode(), 'application/json')
+			return
+
+		try:
+			kind, year, top_n, darkmode = parse_chart_request(self.path)
+			png = self.chart_server.render(kind, year=year, top_n=top_n, darkmode=darkmode)
+		except ChartNotFound as e:
+			self._send_error(404, str(e))
+		except ValueError as e:
+			self._send_error(400, str(e))
+		except RenderError as e:
+			self._send_error(500, f'could not render the chart:\n{e}')
+		except Exception:
+			# a bug, the request still gets an answer and the server log the traceback
+			print(traceback.format_exc())
+			self._send_error(500, 'internal error, see the server log')
+		else:
+			self._send(200, png, 'image/png')
+
+
+def serve(chart_server, host='127.0.0.1', port=8000):
+	handler = type('Handler', (ChartRequestHandler,), {'chart_server': chart_server})
+	httpd = http.server.ThreadingHTTPServer((host, port), handler)
+	print(f'- Serving charts at http://{host}:{httpd.server_port}/')
+	try:
+		httpd.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		httpd.server_close()
+		chart_server.close()
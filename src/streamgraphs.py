@@ -1,24 +1,78 @@
-from src.plot_formatting import set_font, get_discrete_colors, get_axis_and_grid_colors, format_hours
-from matplotlib.dates import YearLocator, MonthLocator, DateFormatter
-from scipy.ndimage import gaussian_filter1d
-from matplotlib import pyplot as plt
-from scipy import stats
+from src.plot_formatting import set_font, get_discrete_colors, get_axis_and_grid_colors, format_hours, set_render_profile, DEFAULT_RENDER_PROFILE
+from src.scheduler import ChartJob, run_chart_jobs
+from src.tracing import traced, span
+from src.lazy_imports import lazy_import
 import pandas as pd
 import numpy as np
-import traceback
 import os
 
+mdates = lazy_import('matplotlib.dates')
+ndimage = lazy_import('scipy.ndimage')
+plt = lazy_import('matplotlib.pyplot')
+
 pd.options.mode.chained_assignment = None
 
 
-def gaussian_smooth(x, y, sd):
-	weights = np.array([stats.norm.pdf(x, m, sd) for m in x])
-	weights = weights / weights.sum(1)
-	return (weights * y).sum(1)
+# gaussian sigma as a fraction of the plotted time span
+SMOOTHING_SIGMA = 1 / 200
+
+
+def smooth_bins(grouped_df, num_samples):
+	# evaluate the linear interpolation of the bins at num_samples evenly spaced points and blur it there,
+	# sigma is a fixed fraction of the span so the curves look the same at any sample count
+	bin_times = grouped_df.index.values.astype('datetime64[ns]').astype(np.int64)
+	sample_times = np.linspace(bin_times[0], bin_times[-1], num_samples)
+	sigma = num_samples * SMOOTHING_SIGMA
+
+	values = np.empty((num_samples, len(grouped_df.columns)))
+	for i, col in enumerate(grouped_df.columns):
+		values[:, i] = ndimage.gaussian_filter1d(np.interp(sample_times, bin_times, grouped_df[col].values.astype(float)), sigma)
+
+	return pd.DataFrame(values, index=pd.DatetimeIndex(sample_times.astype(np.int64).astype('datetime64[ns]')), columns=grouped_df.columns)
 
-def create_streamgraphs(df, output_dir, top_n=10, darkmode=True, podcasts=False):
-	print(f"STREAMGRAPHS")
-	print(f"-----------")
+
+def create_streamgraphs(cube, output_dir, top_n=10, darkmode=True, podcasts=False, jobs=1, profile=DEFAULT_RENDER_PROFILE):
+	return run_chart_jobs(plan_streamgraphs(cube, output_dir, top_n=top_n, darkmode=darkmode, podcasts=podcasts, profile=profile), jobs=jobs, output_dir=output_dir)
+
+
+def select_top_targets(pair_totals, group_target, top_n):
+	# rank the per-target totals, keeping the biggest (target, artist) pair for each name
+	totals = (pair_totals.sort_values(ascending=False) / 3600000).rename('hours_played')
+	totals = totals.reset_index().drop_duplicates(subset=group_target[0]).head(top_n)
+	totals[group_target] = totals[group_target].astype(object)
+	return totals.reset_index(drop=True)
+
+
+def streamgraph_matrix(df, target_col, targets, resample_value):
+	# (target x (year, bin)) ms_played over the whole history. bins are weeks ending on sunday (same as resample('W'))
+	# or month ends (resample('M')), a week that straddles new year gets a column in both years
+	df = df[df[target_col].isin(targets)]
+	if resample_value == "W":
+		bins = df['week'] + pd.Timedelta(days=6)
+	else:
+		bins = pd.to_datetime(pd.DataFrame({'year': df['year'], 'month': df['month'], 'day': 1})) + pd.offsets.MonthEnd(0)
+
+	matrix = df.groupby([target_col, 'year', bins.rename('bin')], observed=True)['ms_played'].sum().unstack(['year', 'bin'], fill_value=0)
+	matrix.index = matrix.index.astype(object)
+	return matrix.sort_index(axis=1)
+
+
+def streamgraph_view(matrix, targets, year=None):
+	# bins x targets for one year (or every year), trimmed to the bins the targets were played in.
+	# None when they were never played for more than 0 ms, there is nothing to draw
+	view = matrix.loc[targets]
+	view = view[year] if year is not None else view.droplevel('year', axis=1)
+	view = view.T.groupby(level=0).sum()
+
+	played = np.flatnonzero(view.values.sum(axis=1) > 0)
+	if len(played) == 0:
+		return None
+	return view.iloc[played[0]:played[-1] + 1]
+
+
+@traced
+def plan_streamgraphs(cube, output_dir, top_n=10, darkmode=True, podcasts=False, profile=DEFAULT_RENDER_PROFILE):
+	section = 'STREAMGRAPHS'
 
 	if not podcasts:
 		groupings = [['track', 'artist'], ['artist'], ['album', 'artist']]
@@ -29,98 +83,81 @@ def create_streamgraphs(df, output_dir, top_n=10, darkmode=True, podcasts=False)
 		print(f'WARNING: top_n={top_n} is greater than 10. Replacing with 10.')
 		top_n = 10
 
-	min_year = df['year'].min()
-	max_year = df['year'].max()
-
+	chart_jobs = []
 	for grouping in groupings:
+		# each grouping reads the cube of its first column, e.g. ['album', 'artist'] -> cube['album']
+		df = cube[grouping[0]]
+		# group on the normalized titles from format_df, so versions like 'Song - Remastered' count as one
+		clean_col = f'{grouping[0]}_clean'
+		if clean_col in df.columns:
+			df = df.assign(**{grouping[0]: df[clean_col]})
+		years = sorted(df['year'].unique())
+		min_year = years[0]
+		max_year = years[-1]
+
 		grouping_dir = os.path.join(output_dir, f'top_{grouping[0]}s')
 
 		if not os.path.exists(grouping_dir):
 			os.makedirs(grouping_dir)
 
-		full_streamgraph_path = os.path.join(grouping_dir, f'streamgraph_top_{grouping[0]}s_{min_year}-{max_year}.png')
-		if not os.path.exists(full_streamgraph_path):
-			print(f'- Creating {grouping[0]}s streamgraphs at {grouping_dir}...')
-			create_streamgraph(df, full_streamgraph_path, group_target=grouping, top_n=top_n, darkmode=darkmode)
-
-		for year in df['year'].unique():
-			year_df = df[df['year'] == year]
-			year_streamgraph_path = os.path.join(grouping_dir, f'streamgraph_top_{grouping[0]}s_{year}.png')
-			if os.path.exists(year_streamgraph_path):
+		# every year's top N comes from one table of (target, artist, year) totals
+		pair_totals = df.groupby(grouping + ['year'], observed=True)['ms_played'].sum()
+		selections = {None: select_top_targets(pair_totals.groupby(level=grouping, observed=True).sum(), grouping, top_n)}
+		for year in years:
+			selections[year] = select_top_targets(pair_totals.xs(year, level='year'), grouping, top_n)
+
+		# resample once per grouping, only targets that make some top N get a row
+		candidates = pd.unique(np.concatenate([totals[grouping[0]].values for totals in selections.values()]))
+		weekly = streamgraph_matrix(df, grouping[0], candidates, 'W')
+		full = streamgraph_matrix(df, grouping[0], candidates, 'M') if min_year != max_year else weekly
+
+		for year, totals in selections.items():
+			if year is None:
+				path = os.path.join(grouping_dir, f'streamgraph_top_{grouping[0]}s_{min_year}-{max_year}.png')
+				grouped_df = streamgraph_view(full, list(totals[grouping[0]]))
+				years_shown = (min_year, max_year)
+			else:
+				path = os.path.join(grouping_dir, f'streamgraph_top_{grouping[0]}s_{year}.png')
+				grouped_df = streamgraph_view(weekly, list(totals[grouping[0]]), year)
+				years_shown = (year, year)
+
+			if grouped_df is None:
+				print(f'- Skipping {os.path.basename(path)}, nothing in it was played for more than 0 ms')
 				continue
 
-			try:
-				create_streamgraph(year_df, year_streamgraph_path, group_target=grouping, top_n=top_n, darkmode=darkmode)
-			except:
-				print(traceback.format_exc())
-				print(f'Error creating streamgraph for {grouping[0]}, {year}')
+			chart_jobs.append(ChartJob(section, path, create_streamgraph, (grouped_df, totals, path, years_shown), {'group_target': grouping, 'top_n': top_n, 'darkmode': darkmode, 'profile': profile}))
 
-	print()
+	return chart_jobs
 
 
-def create_streamgraph(df, output_path, group_target, top_n=10, darkmode=True):
+def create_streamgraph(grouped_df, totals, output_path, years, group_target, top_n=10, darkmode=True, profile=DEFAULT_RENDER_PROFILE):
 	if darkmode:
 		plt.style.use('dark_background')
 
+	print(f'- Creating top {top_n} {group_target[0]}s streamgraph at {output_path}...')
+
 	padding_amount = 20
 	colors = get_discrete_colors()
 
 	axis_color, grid_color = get_axis_and_grid_colors()
 
 	plt.rcParams['font.family'] = set_font()
+	render_profile = set_render_profile(profile)
 
-	min_year = df['year'].min()
-	max_year = df['year'].max()
+	min_year, max_year = years
 
 	multiyear = False
-	resample_value = "W"
+	bin_offset = pd.offsets.Week(weekday=6)
 	if min_year != max_year:
 		multiyear = True
-		resample_value = "M"
-
-	# regex clean up entries
-	if group_target[0] == 'track' or group_target[0] == 'album':
-		df.loc[:, group_target[0]] = df[group_target[0]].replace(r' -.*', '', regex=True)
-		df.loc[:, group_target[0]] = df[group_target[0]].replace(r' \(.+\)', '', regex=True)
+		bin_offset = pd.offsets.MonthEnd()
 
-	df.loc[:, 'sum_hours_played'] = df.groupby(group_target)['ms_played'].transform('sum') / 3600000
-	top_targets = df.sort_values(by=['sum_hours_played'], ascending=False)[group_target[0]].unique()[:top_n]
-	df = df[df[group_target[0]].isin(top_targets)]
-
-	group_cols = group_target + ['sum_hours_played']
-	targets_to_hours = df[group_cols].drop_duplicates(subset=group_target[0]).sort_values(by=['sum_hours_played'], ascending=False).set_index(group_target[0]).to_dict()['sum_hours_played']
+	top_targets = list(totals[group_target[0]])
+	targets_to_hours = dict(zip(totals[group_target[0]], totals['hours_played']))
 	if len(group_target) > 1:
-		targets_to_artists = df[group_cols].drop_duplicates(subset=group_target[0]).sort_values(by=['sum_hours_played'],ascending=False).set_index(group_target[0]).to_dict()[group_target[1]]
-
-	# Convert the 'ts' column to datetime and set it as the DataFrame index
-	df.loc[:, 'ts'] = pd.to_datetime(df['ts'])
-	df.set_index('ts', inplace=True)
-
-	# Group by 'target' and resample data by month, summing the 'ms_played' for each target
-	grouped_df = df.groupby(group_target[0]).resample(resample_value)['ms_played'].sum().unstack(level=0).fillna(0)
-
-	smooth = grouped_df.copy()
-	# Create a new datetime index with hourly intervals using time interpolation
-	start_time = smooth.index.min()
-	end_time = smooth.index.max()
-	hourly_index = pd.date_range(start=start_time, end=end_time, freq='1H')
-
-	# Reindex the DataFrame with the hourly index and use time interpolation
-	smooth = smooth.reindex(hourly_index).interpolate(method='linear')
-
-	# Smoothing factor (adjust as needed for desired smoothing)
-	sigma = len(smooth) / 200
+		targets_to_artists = dict(zip(totals[group_target[0]], totals[group_target[1]]))
 
-	for col in smooth.columns:
-		smooth[col] = gaussian_filter1d(smooth[col], sigma)
-
-	if not multiyear:
-		smooth['year'] = smooth.index.year
-		smooth = smooth[smooth['year'] == min_year]
-		smooth.drop('year', axis=1, inplace=True)
-		smooth = smooth[:-12]
-
-	smooth = smooth[top_targets]
+	grouped_df = grouped_df.reindex(pd.date_range(grouped_df.index.min(), grouped_df.index.max(), freq=bin_offset), fill_value=0)
 
 	golden_ratio = (1 + 5 ** 0.5) / 2
 	height = 10
@@ -130,12 +167,21 @@ def create_streamgraph(df, output_path, group_target, top_n=10, darkmode=True):
 		width = height*golden_ratio * (max_year - min_year) / 3
 		if width > 50:
 			width = 50
-		DPI = 300
+		DPI = render_profile['multiyear_dpi']
 	else:
 		LEGEND_FONTSIZE = 10
-		DPI = 600
+		DPI = render_profile['dpi']
 		width = height*golden_ratio
 
+	# one sample per output pixel is as much detail as the saved image can show, drafts take fewer
+	smooth = smooth_bins(grouped_df, int(width * DPI * render_profile['stream_density']))
+
+	if not multiyear:
+		smooth = smooth[smooth.index.year == min_year]
+		smooth = smooth[smooth.index <= smooth.index.max() - pd.Timedelta(hours=12)]
+
+	smooth = smooth[top_targets]
+
 	fig, ax = plt.subplots(figsize=(width, height))
 
 	ax.stackplot(smooth.index, smooth.values.T, labels=smooth.columns, colors=colors, baseline="sym", zorder=1000)
@@ -159,16 +205,16 @@ def create_streamgraph(df, output_path, group_target, top_n=10, darkmode=True):
 	if multiyear:
 		title = f"Top {top_n} {group_target[0].capitalize()}s ({min_year}-{max_year})"
 
-		ax.xaxis.set_major_formatter(DateFormatter('%Y'))
-		ax.xaxis.set_minor_locator(MonthLocator(bymonth=[1, 4, 7, 10]))
-		ax.xaxis.set_major_locator(YearLocator())
+		ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y'))
+		ax.xaxis.set_minor_locator(mdates.MonthLocator(bymonth=[1, 4, 7, 10]))
+		ax.xaxis.set_major_locator(mdates.YearLocator())
 
 		ax.xaxis.grid(which='major', linestyle='-', color=grid_color, zorder=-1000)
 		ax.xaxis.grid(which='minor', linestyle=':', color=grid_color, zorder=-1000)
 	else:
 		title = f"Top {top_n} {group_target[0].title()}s of {min_year}"
-		ax.xaxis.set_major_locator(MonthLocator())
-		ax.xaxis.set_major_formatter(DateFormatter('%b'))
+		ax.xaxis.set_major_locator(mdates.MonthLocator())
+		ax.xaxis.set_major_formatter(mdates.DateFormatter('%b'))
 		ax.xaxis.grid(which='major', linestyle='--', color=grid_color, zorder=-1000)
 
 	# Tick formatting
@@ -177,9 +223,9 @@ def create_streamgraph(df, output_path, group_target, top_n=10, darkmode=True):
 	ax.set_yticklabels([])
 
 	for tick in ax.xaxis.get_major_ticks():
-		tick.label.set_fontsize(14)
-		tick.label.set_fontweight('bold')
-		tick.label.set_color(grid_color)
+		tick.label1.set_fontsize(14)
+		tick.label1.set_fontweight('bold')
+		tick.label1.set_color(grid_color)
 
 	plt.title(title, fontsize=30, fontweight='bold', color=grid_color, pad=padding_amount)
 
@@ -189,8 +235,10 @@ def create_streamgraph(df, output_path, group_target, top_n=10, darkmode=True):
 	ax.spines['bottom'].set_visible(False)
 	ax.spines['left'].set_visible(False)
 
-	plt.tight_layout()
-	plt.savefig(output_path, dpi=DPI, facecolor=fig.get_facecolor(), edgecolor='none')
+	with span('layout'):
+		plt.tight_layout()
+	with span('savefig'):
+		plt.savefig(output_path, dpi=DPI, facecolor=fig.get_facecolor(), edgecolor='none')
 
 	plt.clf()
 	plt.close()
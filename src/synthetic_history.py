@@ -0,0 +1,166 @@
+import numpy as np
+import json
+import os
+
+# what a real export mixes: plain utf-8, a BOM, utf-16 with and without one
+SYNTHETIC_ENCODINGS = ['utf-8', 'utf-8-sig', 'utf-16', 'utf-16-le']
+# Spotify splits extended history into files of roughly this many plays
+RECORDS_PER_FILE = 15000
+
+ZIPF_EXPONENT = 1.1
+ALBUMS_PER_ARTIST = 4
+TRACKS_PER_ALBUM = 10
+EPISODES_PER_SHOW = 200
+PODCAST_SHARE = 0.1
+
+# some accented syllables so names need more than ascii in every encoding
+SYLLABLES = ['ka', 'lo', 'mé', 'ri', 'sø', 'tan', 'vu', 'ña', 'el', 'dö', 'zi', 'ra', 'bo', 'nu', 'çe', 'ti']
+# decorations the normalized titles strip off
+ALBUM_EDITIONS = ['', '', '', ' (Deluxe Edition)', ' (Remastered)']
+TRACK_EDITIONS = ['', '', '', '', ' - Remastered 2011', ' (feat. Someone)', ' - Live']
+
+PLATFORMS = ['ios', 'android', 'osx', 'windows', 'web_player']
+COUNTRIES = ['US', 'GB', 'DE', 'SE', 'BR', 'JP']
+REASONS_START = ['trackdone', 'fwdbtn', 'clickrow', 'playbtn']
+REASONS_END = ['trackdone', 'fwdbtn', 'endplay', 'logout']
+
+
+def synthetic_name(index):
+	# a unique pronounceable name per index, the same index always gives the same name
+	parts = []
+	index += len(SYLLABLES)
+	while index > 0:
+		index, digit = divmod(index, len(SYLLABLES))
+		parts.append(SYLLABLES[digit])
+	return ''.join(reversed(parts)).capitalize()
+
+
+def zipf_choice(rng, n, size, exponent=ZIPF_EXPONENT):
+	# rank k is drawn with probability proportional to 1 / k^exponent, over a fixed vocabulary of n
+	weights = 1 / np.arange(1, n + 1) ** exponent
+	return rng.choice(n, size=size, p=weights / weights.sum())
+
+
+def synthetic_vocabulary_sizes(num_plays):
+	# catalogue sizes grow with the history, as a heavier listener finds more artists
+	num_artists = int(min(50000, max(20, num_plays // 200)))
+	num_shows = int(min(2000, max(5, num_plays // 5000)))
+	return num_artists, num_shows
+
+
+def _music_records(rng, ts, num_artists):
+	n = len(ts)
+	artists = zipf_choice(rng, num_artists, n)
+	albums = zipf_choice(rng, ALBUMS_PER_ARTIST, n)
+	tracks = zipf_choice(rng, TRACKS_PER_ALBUM, n)
+	# long tails: most plays are skips or full listens of a 2-5 minute track
+	ms_played = np.clip(rng.lognormal(np.log(150000), 0.8, n), 0, 900000).astype(np.int64)
+
+	records = []
+	for i, (artist, album, track) in enumerate(zip(artists.tolist(), albums.tolist(), tracks.tolist())):
+		artist_name = synthetic_name(artist)
+		album_id = artist * ALBUMS_PER_ARTIST + album
+		track_id = album_id * TRACKS_PER_ALBUM + track
+		records.append({
+			'ts': ts[i],
+			'ms_played': int(ms_played[i]),
+			'master_metadata_track_name': f'{synthetic_name(track_id)}{TRACK_EDITIONS[track_id % len(TRACK_EDITIONS)]}',
+			'master_metadata_album_artist_name': artist_name,
+			'master_metadata_album_album_name': f'{synthetic_name(album_id)}{ALBUM_EDITIONS[album_id % len(ALBUM_EDITIONS)]}',
+			'spotify_track_uri': f'spotify:track:{track_id:022x}',
+			'episode_name': None,
+			'episode_show_name': None,
+			'spotify_episode_uri': None,
+		})
+	return records
+
+
+def _podcast_records(rng, ts, num_shows):
+	n = len(ts)
+	shows = zipf_choice(rng, num_shows, n)
+	episodes = rng.integers(0, EPISODES_PER_SHOW, n)
+	ms_played = np.clip(rng.lognormal(np.log(1200000), 0.9, n), 0, 10800000).astype(np.int64)
+
+	records = []
+	for i, (show, episode) in enumerate(zip(shows.tolist(), episodes.tolist())):
+		episode_id = show * EPISODES_PER_SHOW + episode
+		records.append({
+			'ts': ts[i],
+			'ms_played': int(ms_played[i]),
+			'master_metadata_track_name': None,
+			'master_metadata_album_artist_name': None,
+			'master_metadata_album_album_name': None,
+			'spotify_track_uri': None,
+			'episode_name': f'Episode {episode}: {synthetic_name(episode_id)}',
+			'episode_show_name': f'The {synthetic_name(show)} Show',
+			'spotify_episode_uri': f'spotify:episode:{episode_id:022x}',
+		})
+	return records
+
+
+def _add_session_fields(rng, records):
+	n = len(records)
+	platforms = rng.integers(0, len(PLATFORMS), n).tolist()
+	countries = rng.integers(0, len(COUNTRIES), n).tolist()
+	reasons_start = rng.integers(0, len(REASONS_START), n).tolist()
+	reasons_end = rng.integers(0, len(REASONS_END), n).tolist()
+	shuffle = (rng.random(n) < 0.5).tolist()
+	skipped = (rng.random(n) < 0.2).tolist()
+	offline = (rng.random(n) < 0.05).tolist()
+
+	for i, record in enumerate(records):
+		record.update({
+			'username': 'synthetic',
+			'platform': PLATFORMS[platforms[i]],
+			'conn_country': COUNTRIES[countries[i]],
+			'ip_addr_decrypted': '127.0.0.1',
+			'user_agent_decrypted': None,
+			'reason_start': REASONS_START[reasons_start[i]],
+			'reason_end': REASONS_END[reasons_end[i]],
+			'shuffle': shuffle[i],
+			'skipped': skipped[i],
+			'offline': offline[i],
+			'offline_timestamp': 0,
+			'incognito_mode': False,
+		})
+	return records
+
+
+def generate_history(output_dir, num_plays, seed=0, start_year=2015, num_years=5, records_per_file=RECORDS_PER_FILE, podcast_share=PODCAST_SHARE):
+	# writes Streaming_History_Audio_*.json files for num_plays plays spread over num_years,
+	# the same arguments always produce byte-identical files. returns the file paths
+	if not os.path.exists(output_dir):
+		os.makedirs(output_dir)
+
+	rng = np.random.default_rng(seed)
+	num_artists, num_shows = synthetic_vocabulary_sizes(num_plays)
+
+	# exports are in time order, each file covers the next stretch of plays
+	start = np.datetime64(f'{start_year}-01-01T00:00:00', 's')
+	end = np.datetime64(f'{start_year + num_years}-01-01T00:00:00', 's')
+	offsets = np.sort(rng.integers(0, int((end - start) / np.timedelta64(1, 's')), num_plays))
+
+	paths = []
+	for file_index, first in enumerate(range(0, num_plays, records_per_file)):
+		times = start + offsets[first:first + records_per_file].astype('timedelta64[s]')
+		ts = np.datetime_as_string(times, unit='s')
+		ts = [f'{t}Z' for t in ts.tolist()]
+
+		is_podcast = rng.random(len(ts)) < podcast_share
+		music = _music_records(rng, [t for t, podcast in zip(ts, is_podcast) if not podcast], num_artists)
+		podcasts = _podcast_records(rng, [t for t, podcast in zip(ts, is_podcast) if podcast], num_shows)
+		records = _add_session_fields(rng, sorted(music + podcasts, key=lambda record: record['ts']))
+
+		years = f'{times[0].astype(object).year}-{times[-1].astype(object).year}'
+		file_name = f'Streaming_History_Audio_{years}_{file_index}.json'
+		path = os.path.join(output_dir, file_name)
+		encoding = SYNTHETIC_ENCODINGS[file_index % len(SYNTHETIC_ENCODINGS)]
+
+		# the temp name must not look like a history file to list_history_files
+		temp_path = os.path.join(output_dir, f'.{file_name}.tmp')
+		with open(temp_path, 'w', encoding=encoding) as fp:
+			json.dump(records, fp, ensure_ascii=False)
+		os.replace(temp_path, path)
+		paths.append(path)
+
+	return paths
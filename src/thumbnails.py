@@ -0,0 +1,58 @@
+from src.lazy_imports import lazy_import
+import numpy as np
+import threading
+import hashlib
+import os
+
+Image = lazy_import('PIL.Image')
+
+THUMBNAIL_DIR = 'thumbnails'
+
+# one store per directory and process, so every album chart a worker renders shares the hashes and mapped arrays
+_stores = {}
+
+
+class ThumbnailStore:
+	# resized covers as .npy files named by the hash of the source image and the size,
+	# the same artwork under two album names is decoded and resized once
+	def __init__(self, directory):
+		self.directory = directory
+		self.hashes = {}
+		self.arrays = {}
+
+	def content_hash(self, image_path):
+		stat = os.stat(image_path)
+		file_key = (image_path, stat.st_size, stat.st_mtime_ns)
+		if file_key not in self.hashes:
+			with open(image_path, 'rb') as fp:
+				self.hashes[file_key] = hashlib.sha1(fp.read()).hexdigest()
+		return self.hashes[file_key]
+
+	def get(self, image_path, img_size):
+		key = f'{self.content_hash(image_path)}_{img_size}'
+		if key in self.arrays:
+			return self.arrays[key]
+
+		path = os.path.join(self.directory, f'{key}.npy')
+		if not os.path.exists(path):
+			if not os.path.exists(self.directory):
+				os.makedirs(self.directory)
+
+			img = Image.open(image_path)
+			img = img.resize((img_size, img_size))
+
+			# unique per writer, processes sharing the store may resize the same cover at once
+			temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp.npy'
+			np.save(temp_path, np.asarray(img, dtype=np.uint8))
+			os.replace(temp_path, path)
+
+		# memory mapped, every chart in the run reads the same pages
+		self.arrays[key] = np.load(path, mmap_mode='r')
+		return self.arrays[key]
+
+
+def get_thumbnail_store(directory):
+	directory = os.path.abspath(directory)
+	if directory not in _stores:
+		_stores[directory] = ThumbnailStore(directory)
+	return _stores[directory]
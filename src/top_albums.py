@@ -1,33 +1,32 @@
-from src.plot_formatting import set_plot, set_font, get_discrete_colors, get_axis_and_grid_colors
-from matplotlib.offsetbox import OffsetImage, AnnotationBbox
-from matplotlib import pyplot as plt
-from PIL import Image
-import urllib.request
+from src.plot_formatting import set_plot, set_font, get_discrete_colors, get_axis_and_grid_colors, set_render_profile, DEFAULT_RENDER_PROFILE
+from src.album_art import AlbumArtFetcher, ITUNES_SEARCH_URL
+from src.thumbnails import get_thumbnail_store, THUMBNAIL_DIR
+from src.scheduler import ChartJob, run_chart_jobs
+from src.tracing import traced, span
+from src.entities import normalize_title
+from src.lazy_imports import lazy_import
 import pandas as pd
 import numpy as np
-import traceback
-import requests
-import json
-import re
 import os
 
+offsetbox = lazy_import('matplotlib.offsetbox')
+plt = lazy_import('matplotlib.pyplot')
+Image = lazy_import('PIL.Image')
 
-def group_df_by_target(df, target_col, top_n, output_dir):
-	album_art_dir = os.path.join(output_dir, 'album_art_dir')
-	if not os.path.exists(album_art_dir):
-		os.makedirs(album_art_dir)
-	jpeg_dict = {}
 
+def group_df_by_target(df, target_col, top_n):
 	album = target_col[0]
 	artist = target_col[1]
 
-	unique_artists_per_album = df.groupby(album)[artist].nunique().reset_index()
+	unique_artists_per_album = df.groupby(album, observed=True)[artist].nunique().reset_index()
 	unique_artists_per_album.rename(columns={artist: 'unique_artists'}, inplace=True)
 
-	grouped_df = df.groupby(target_col)['ms_played'].sum()
+	grouped_df = df.groupby(target_col, observed=True)['ms_played'].sum()
 	grouped_df = grouped_df.reset_index()
 
 	grouped_df = pd.merge(grouped_df, unique_artists_per_album, on=album)
+	# only a few hundred rows left, plain strings make room for 'Various Artists'
+	grouped_df[target_col] = grouped_df[target_col].astype(object)
 
 	grouped_df.loc[grouped_df['unique_artists'] > 1, artist] = 'Various Artists'
 	grouped_df = grouped_df.groupby(target_col)['ms_played'].sum()
@@ -35,81 +34,55 @@ def group_df_by_target(df, target_col, top_n, output_dir):
 
 	# convert ms to hours
 	grouped_df['hours_played'] = grouped_df['ms_played'] / 3600000
-	# sort by hours_played
-	grouped_df = grouped_df.sort_values(by='hours_played', ascending=False)
-
-	# get top 100
-	grouped_df = grouped_df.head(top_n)
-
-	album_col_name = target_col[0]
-	artist_col_name = target_col[1]
-	for i, r in grouped_df.iterrows():
-		album = r[album_col_name]
-		artist = r[artist_col_name]
-
-		found = False
-		attempts = 0
-		temp_album, temp_artist = None, None
-		while found == False:
-			if attempts > 5:
-				temp_album = album
-				temp_artist = artist
-			if attempts > 15:
-				raise Exception(f'could not find album art for {album} by {artist} after {attempts} attempts')
-			try:
-				album_art_path = os.path.join(album_art_dir, f'{album.replace(" ", "_")}.jpg')
-				if os.path.exists(album_art_path):
-					jpeg_dict[album] = album_art_path
-					found = True
-					break
-
-				if temp_album is not None or temp_artist is not None:
-					if temp_artist is None:
-						temp_artist = artist
-
-					url = f'https://itunes.apple.com/search?term={temp_album.replace(" ", "%20")}%20{temp_artist.replace(" ", "%20")}&entity=album&limit=1'
-				else:
-					url = f'https://itunes.apple.com/search?term={album.replace(" ", "%20")}%20{artist.replace(" ", "%20")}&entity=album&limit=1'
-
-				response = requests.get(url)
-				# if response is successful
-				if response.status_code == 200:
-					response = json.loads(response.text)
-					if len(response['results']) == 0:
-						raise Exception('No results')
-					if 'artworkUrl100' in response['results'][0]:
-						artwork_url = response['results'][0]['artworkUrl100']
-						urllib.request.urlretrieve(artwork_url, album_art_path)
-						jpeg_dict[album] = album_art_path
-						found = True
-					else:
-						raise Exception('No artworkUrl100')
-				else:
-					raise Exception('Response not 200')
-			except:
-				if attempts == 1:
-					temp_album = re.sub(r'\([^)]*\)', '', album)
-					temp_album = re.sub(r'\[[^)]*\]', '', temp_album)
-				if attempts == 2:
-					temp_artist = ""
-				if attempts == 3:
-					temp_album = album.split(":")[0].strip()
-					temp_album = temp_album.split("-")[0].strip()
-
-				attempts += 1
-
-	# save jpeg_dict to json
-	jpeg_path = os.path.join(output_dir, 'jpeg_dict.json')
-	with open(jpeg_path, 'w') as fp:
-		json.dump(jpeg_dict, fp)
+	# get the top n by hours_played
+	grouped_df = grouped_df.nlargest(top_n, 'hours_played')
+
+	# the normalized titles from format_df, the album art search falls back to the same key as the streamgraphs
+	clean_col = f'{album}_clean'
+	if clean_col in df.columns:
+		titles = df[[album, clean_col]].drop_duplicates(subset=album)
+		clean_titles = dict(zip(titles[album].astype(object), titles[clean_col].astype(object)))
+		grouped_df['clean_album'] = grouped_df[album].map(clean_titles)
+	else:
+		grouped_df['clean_album'] = grouped_df[album].map(normalize_title)
 
 	# reset index
 	grouped_df = grouped_df.reset_index(drop=True)
 
-	return grouped_df, jpeg_dict
+	return grouped_df
 
 
-def load_image(image_path, img_size):
+@traced
+def fetch_album_art(grouped_dfs, target_col, album_art_dir, search_url=ITUNES_SEARCH_URL):
+	# one concurrent fetch for the albums of every chart, the lookups are remembered in the album art index
+	albums = []
+	for grouped_df in grouped_dfs:
+		albums.extend(zip(grouped_df[target_col[0]], grouped_df[target_col[1]], grouped_df['clean_album']))
+
+	fetcher = AlbumArtFetcher(album_art_dir, search_url=search_url)
+	return fetcher.fetch_all(albums)
+
+
+def album_art_for(grouped_df, target_col, art):
+	# the cover of each bar, by (album, artist) since two artists can have an album of the same name.
+	# None for albums without art, they get a placeholder
+	return [art.get((album, artist)) for album, artist in zip(grouped_df[target_col[0]], grouped_df[target_col[1]])]
+
+
+def placeholder_image(img_size):
+	_, grid_color = get_axis_and_grid_colors()
+	rgb = [int(grid_color[i:i + 2], 16) for i in (1, 3, 5)]
+	return np.full((img_size, img_size, 3), rgb, dtype=np.uint8)
+
+
+def load_image(image_path, img_size, thumbnails=None):
+	if image_path is None:
+		return placeholder_image(img_size)
+
+	# the store hands out covers that were already resized on this or an earlier run
+	if thumbnails is not None:
+		return thumbnails.get(image_path, img_size)
+
 	# Load and resize the image to a custom size for the bar chart label
 	img = Image.open(image_path)
 	img = img.resize((img_size, img_size))
@@ -149,9 +122,13 @@ def add_value_labels(ax, color, spacing=5):
 			va=va)
 
 
-def create_image_barchart(labels, values, jpeg_dict, output_file, top_n, img_size=100, bar_width=.6, DPI=600,
-                          append_title="", years=None):
+def create_image_barchart(labels, values, image_paths, output_file, top_n, img_size=100, bar_width=.6, DPI=600,
+                          append_title="", years=None, ranks=None, thumbnails=None, profile=DEFAULT_RENDER_PROFILE):
+	# ranks label the bars, they start over for every year of the full chart
 	plt.style.use('default')
+	render_profile = set_render_profile(profile)
+	# covers are resized to the profile's size and zoomed back to the layout's img_size
+	thumbnail_size = render_profile['thumbnail_size']
 
 	print(f"- Creating top {top_n} albums chart at {output_file}...")
 
@@ -159,18 +136,17 @@ def create_image_barchart(labels, values, jpeg_dict, output_file, top_n, img_siz
 	plot_color = colors[0]
 	fig, ax = plt.subplots()
 
-	for i, (label, value) in enumerate(zip(labels, values)):
-		# Load the image corresponding to the label
-		image_path = jpeg_dict[label]
-		image = load_image(image_path, img_size)
+	for i, (value, image_path) in enumerate(zip(values, image_paths)):
+		# Load the image of the bar
+		image = load_image(image_path, thumbnail_size, thumbnails=thumbnails)
 
 		# Plot the bar
 		x_pos = i
 		ax.bar(x_pos, value, bar_width, align='center', color=plot_color, zorder=3)
 
 		# Add the image as a label beneath the bar
-		imagebox = OffsetImage(image, zoom=1.23)
-		ab = AnnotationBbox(imagebox, (x_pos, 0), xybox=(0, -img_size / 1), frameon=False, xycoords='data',
+		imagebox = offsetbox.OffsetImage(image, zoom=1.23 * img_size / thumbnail_size)
+		ab = offsetbox.AnnotationBbox(imagebox, (x_pos, 0), xybox=(0, -img_size / 1), frameon=False, xycoords='data',
 		                    boxcoords="offset points", pad=8)
 		ax.add_artist(ab)
 
@@ -186,14 +162,15 @@ def create_image_barchart(labels, values, jpeg_dict, output_file, top_n, img_siz
 	num_bars = len(labels)
 	ax.set_xticks(range(num_bars))
 
-	repeating_range = list(range(1, top_n + 1)) * int(num_bars / top_n)
-	ax.set_xticklabels(repeating_range, color=axis_color, fontsize=50, fontweight='bold', fontfamily=fontname)
+	if ranks is None:
+		ranks = list(range(1, num_bars + 1))
+	ax.set_xticklabels(ranks, color=axis_color, fontsize=50, fontweight='bold', fontfamily=fontname)
 	ax.xaxis.set_tick_params(pad=200)
 
 	ax.set_yticklabels([int(x) for x in plt.gca().get_yticks()], color=axis_color, fontsize=30, fontfamily=fontname)
 	ax.yaxis.set_tick_params(pad=55)
 
-	if int(num_bars / top_n) != 1:
+	if years is not None:
 		add_value_labels(ax, axis_color)
 
 	plt.tick_params(axis='both', which='both', length=0)
@@ -207,65 +184,70 @@ def create_image_barchart(labels, values, jpeg_dict, output_file, top_n, img_siz
 	ax.set_title(f'Top {top_n} Albums{append_title}', color=axis_color, fontsize=60, pad=50, fontfamily=fontname)
 	figure_width_inches = 12 * (len(labels) * (img_size / bar_width)) / DPI
 	plt.gcf().set_size_inches(figure_width_inches, 20)  # Adjust figure size based on the number of bars
-	plt.tight_layout()
-	plt.savefig(output_file)
+	with span('layout'):
+		plt.tight_layout()
+	with span('savefig'):
+		plt.savefig(output_file, dpi=render_profile['album_dpi'])
 
 	plt.clf()
 	plt.close()
 
 
-def create_album_charts(df, output_dir, top_n=5, by_year=True):
-	print(f"TOP ALBUMS")
-	print(f"----------")
+def create_album_charts(cube, output_dir, top_n=5, by_year=True, jobs=1, search_url=ITUNES_SEARCH_URL, album_art_dir=None, profile=DEFAULT_RENDER_PROFILE):
+	return run_chart_jobs(plan_album_charts(cube, output_dir, top_n=top_n, by_year=by_year, search_url=search_url, album_art_dir=album_art_dir, profile=profile), jobs=jobs, output_dir=output_dir)
+
+
+def chart_albums(grouped_df, target_col, art):
+	# what one chart draws: the ranked albums, their hours and the file name of each cover in the art store (None without art)
+	return pd.DataFrame({
+		'album': grouped_df[target_col[0]].values,
+		'artist': grouped_df[target_col[1]].values,
+		'hours_played': grouped_df['hours_played'].values,
+		'rank': np.arange(1, len(grouped_df) + 1),
+		'art': [None if path is None else os.path.basename(path) for path in album_art_for(grouped_df, target_col, art)],
+	})
+
+
+@traced
+def plan_album_charts(cube, output_dir, top_n=5, by_year=True, search_url=ITUNES_SEARCH_URL, album_art_dir=None, profile=DEFAULT_RENDER_PROFILE):
+	# album_art_dir defaults to one next to the charts, pass a shared one to reuse covers across output directories
+	section = 'TOP ALBUMS'
+	grouping_cols = ['album', 'artist']
+
 	top_albums_dir = os.path.join(output_dir, 'top_albums')
 	if not os.path.exists(top_albums_dir):
 		os.makedirs(top_albums_dir)
-
-	grouping_cols = ['album', 'artist']
-	if by_year:
-		# filter df by year
-		full_labels = []
-		full_values = []
-		jpeg_master_dict = {}
-		years = list(sorted(df['year'].unique()))
-		for year in years:
-			output_file = os.path.join(top_albums_dir, f'top_albums_{year}.png')
-			if os.path.exists(output_file):
-				continue
-
-			temp_df = df[df['year'] == year]
-
-			try:
-				grouped_df, jpeg_dict = group_df_by_target(temp_df, grouping_cols, top_n, top_albums_dir)
-			except:
-				print(traceback.format_exc())
-				print(f'Error grouping df for {year}, skipping...')
-				continue
-
-			labels = grouped_df[grouping_cols[0]].values
-			full_labels.extend(labels)
-			values = grouped_df['hours_played'].values
-
-			full_values.extend(values)
-			jpeg_master_dict.update(jpeg_dict)
-
-			create_image_barchart(labels, values, jpeg_dict, output_file, top_n, append_title=f' {year}')
-
-		if min(years) != max(years):
-			output_file = os.path.join(top_albums_dir, f'top_albums_full.png')
-			if not os.path.exists(output_file):
-				create_image_barchart(full_labels, full_values, jpeg_master_dict, output_file, top_n,
-				                      append_title=f' {min(years)} - {max(years)}', years=years)
-
-	try:
-		grouped_df, jpeg_dict = group_df_by_target(df, grouping_cols, top_n, top_albums_dir)
-		labels = grouped_df[grouping_cols[0]].values
-		values = grouped_df['hours_played'].values
-
-		output_file = os.path.join(top_albums_dir, f'top_albums_all_time.png')
-		if not os.path.exists(output_file):
-			create_image_barchart(labels, values, jpeg_dict, output_file, top_n)
-	except:
-		print(traceback.format_exc())
-
-	print()
+	if album_art_dir is None:
+		album_art_dir = os.path.join(top_albums_dir, 'album_art_dir')
+
+	# rank every chart first so all the album art is fetched in one concurrent batch, the charts only read the files
+	years = list(sorted(cube['year'].unique())) if by_year else []
+	year_dfs = {year: group_df_by_target(cube[cube['year'] == year], grouping_cols, top_n) for year in years}
+	all_time_df = group_df_by_target(cube, grouping_cols, top_n)
+
+	print('- Fetching album art...')
+	art = fetch_album_art(list(year_dfs.values()) + [all_time_df], grouping_cols, album_art_dir, search_url=search_url)
+
+	# a job per chart keyed on its own albums, a play in one year only re-renders that year and the full chart
+	chart_jobs = []
+	kwargs = {'top_n': top_n, 'album_art_dir': album_art_dir, 'profile': profile}
+	year_albums = {year: chart_albums(year_dfs[year], grouping_cols, art) for year in years}
+	for year, albums in year_albums.items():
+		output_file = os.path.join(top_albums_dir, f'top_albums_{year}.png')
+		chart_jobs.append(ChartJob(section, output_file, album_chart, (albums, output_file), {**kwargs, 'append_title': f' {year}'}))
+
+	if len(years) > 1:
+		output_file = os.path.join(top_albums_dir, f'top_albums_full.png')
+		full_albums = pd.concat(year_albums.values(), ignore_index=True)
+		chart_jobs.append(ChartJob(section, output_file, album_chart, (full_albums, output_file), {**kwargs, 'append_title': f' {min(years)} - {max(years)}', 'years': years}))
+
+	output_file = os.path.join(top_albums_dir, f'top_albums_all_time.png')
+	chart_jobs.append(ChartJob(section, output_file, album_chart, (chart_albums(all_time_df, grouping_cols, art), output_file), kwargs))
+	return chart_jobs
+
+
+def album_chart(albums, output_file, top_n, album_art_dir, append_title="", years=None, profile=DEFAULT_RENDER_PROFILE):
+	thumbnails = get_thumbnail_store(os.path.join(album_art_dir, THUMBNAIL_DIR))
+	image_paths = [None if name is None else os.path.join(album_art_dir, name) for name in albums['art']]
+	create_image_barchart(albums['album'].values, albums['hours_played'].values, image_paths, output_file, top_n,
+	                      append_title=append_title, years=years, ranks=list(albums['rank']), thumbnails=thumbnails, profile=profile)
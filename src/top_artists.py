@@ -1,37 +1,37 @@
-from src.plot_formatting import find_cleanest_columns, set_font, get_discrete_colors, get_axis_and_grid_colors
-from matplotlib import pyplot as plt
+from src.plot_formatting import find_cleanest_columns, set_font, get_discrete_colors, get_axis_and_grid_colors, set_render_profile, DEFAULT_RENDER_PROFILE
+from src.cube import top_entities, entity_year_matrix
+from src.figure_templates import get_figure_template
+from src.scheduler import ChartJob, run_chart_jobs
+from src.tracing import traced, span
+from src.lazy_imports import lazy_import
+import numpy as np
 import os
 
+plt = lazy_import('matplotlib.pyplot')
 
-def create_artist_charts(df, output_dir, top_n=20, darkmode=True):
-    print(f"TOP ARTISTS")
-    print(f"-----------")
+
+def create_artist_charts(cube, output_dir, top_n=20, darkmode=True, jobs=1, profile=DEFAULT_RENDER_PROFILE):
+    return run_chart_jobs(plan_artist_charts(cube, output_dir, top_n=top_n, darkmode=darkmode, profile=profile), jobs=jobs, output_dir=output_dir)
+
+
+@traced
+def plan_artist_charts(cube, output_dir, top_n=20, darkmode=True, profile=DEFAULT_RENDER_PROFILE):
+    section = 'TOP ARTISTS'
 
     artist_output_dir = os.path.join(output_dir, 'top_artists')
     if not os.path.exists(artist_output_dir):
         os.makedirs(artist_output_dir)
 
-    df['sum_hours_played'] = df.groupby('artist')['ms_played'].transform('sum')
-    df = df.sort_values(by=['sum_hours_played', 'year'], ascending=False)
-    top_artists = df['artist'].unique()[:top_n]
+    top_artists = list(top_entities(cube, ['artist'], top_n).index)
 
-    full_df = df.copy()
-    full_df = full_df.groupby(['year', 'artist']).sum()
+    full_df = cube.groupby(['year', 'artist'], observed=True)['ms_played'].sum()
     full_df = full_df.reset_index()
 
-    df = df[df['artist'].isin(top_artists)]
-    df = df.groupby(['artist', 'year']).sum()
-    df = df.reset_index()
+    years = sorted(full_df.loc[full_df['artist'].isin(top_artists), 'year'].unique())
+    matrix = entity_year_matrix(cube, ['artist'], top_artists, years)
 
-    df = df[['artist', 'year', 'ms_played']]
-
-    years = df['year'].unique()
-    # Complete df
-    for year in years:
-        for artist in top_artists:
-            if not artist in df.loc[df['year'] == year]['artist'].values:
-                # add new row for artist, year with ms_played=0
-                df = df.append({'artist': artist, 'year': year, 'ms_played': 0}, ignore_index=True)
+    # long form of the matrix, every (top artist, year) pair is present
+    df = matrix.stack().rename('ms_played').reset_index()
 
     top_artists = [(i, x) for i, x in enumerate(top_artists)]
     top_artists.reverse()
@@ -39,25 +39,20 @@ def create_artist_charts(df, output_dir, top_n=20, darkmode=True):
     artist_path_by_year = os.path.join(artist_output_dir, 'top_artists_all_time_by_year.png')
     artist_path = os.path.join(artist_output_dir, 'top_artists_all_time.png')
 
-    df.loc[:, 'sum_hours_played'] = df.groupby('artist')['ms_played'].transform('sum') / 3600000
-    if not os.path.exists(artist_path_by_year):
-        top_artist_by_year(df, top_artists, years, artist_path_by_year, top_n=top_n, darkmode=darkmode)
-    if not os.path.exists(artist_path):
-        top_artist(df, artist_path, top_n=top_n, darkmode=darkmode)
+    chart_jobs = []
+    chart_jobs.append(ChartJob(section, artist_path_by_year, top_artist_by_year, (matrix, top_artists, years, artist_path_by_year), {'top_n': top_n, 'darkmode': darkmode, 'profile': profile}))
+    chart_jobs.append(ChartJob(section, artist_path, top_artist, (df, artist_path), {'top_n': top_n, 'darkmode': darkmode, 'profile': profile}))
 
     # group full_df by year
     for year in years:
         temp_df = full_df[full_df['year'] == year]
         year_path = os.path.join(artist_output_dir, f'top_artists_{year}.png')
-        if os.path.exists(year_path):
-            continue
-
-        top_artist(temp_df, year_path, top_n=top_n, darkmode=darkmode)
+        chart_jobs.append(ChartJob(section, year_path, top_artist, (temp_df, year_path), {'top_n': top_n, 'darkmode': darkmode, 'profile': profile}))
 
-    print()
+    return chart_jobs
 
 
-def top_artist(df, output_path, top_n, darkmode=True):
+def top_artist(df, output_path, top_n, darkmode=True, profile=DEFAULT_RENDER_PROFILE):
     colors = get_discrete_colors()
     axis_color, grid_color = get_axis_and_grid_colors()
 
@@ -73,51 +68,57 @@ def top_artist(df, output_path, top_n, darkmode=True):
     padding_amount = 20
 
     plt.rcParams['font.family'] = set_font()
+    render_profile = set_render_profile(profile)
 
     golden_ratio = (1 + 5 ** 0.5) / 2
     height = 10
-    fig, ax = plt.subplots(figsize=(height*golden_ratio, height))
-    plt.grid(True, axis='x', color=grid_color, linewidth=1, zorder=-999, linestyle='--')
+
+    def build(ax):
+        ax.grid(True, axis='x', color=grid_color, linewidth=1, zorder=-999, linestyle='--')
+        ax.set_ylabel('Artist', fontsize=16, fontweight='bold', color=axis_color, labelpad=padding_amount)
+        ax.set_xlabel('Hours Listened', fontsize=16, fontweight='bold', color=axis_color, labelpad=padding_amount)
+
+        # Set spines
+        ax.spines['left'].set_zorder(1000)
+        ax.spines['top'].set_visible(False)
+        ax.spines['right'].set_visible(False)
+        ax.spines['bottom'].set_visible(False)
+        ax.spines['left'].set_visible(True)
+
+    # the skeleton is shared by every artist chart in this style, only the bars, tick labels and title change
+    fig, ax = get_figure_template(('top_artist', darkmode, profile), (height*golden_ratio, height), build)
 
     min_year = df['year'].min()
     max_year = df['year'].max()
 
-    df['sum_hours_played'] = df.groupby(['artist'])['ms_played'].transform('sum') / 3600000
+    df['sum_hours_played'] = df.groupby(['artist'], observed=True)['ms_played'].transform('sum') / 3600000
     df = df[['artist', 'sum_hours_played']]
     df = df.drop_duplicates()
     df = df.sort_values(by='sum_hours_played', ascending=False)
     top_artists = [(i, x) for i, x in enumerate(df['artist'].unique())][:top_n]
     top_artists.reverse()
 
-    for i, artist in top_artists:
-        ax.barh(f"{artist}: #{i+1}", df[df['artist'] == artist]['sum_hours_played'], color=colors[0], zorder=999, height=0.5)
+    for position, (i, artist) in enumerate(top_artists):
+        ax.barh(position, df[df['artist'] == artist]['sum_hours_played'], color=colors[0], zorder=999, height=0.5)
+    ax.set_yticks(range(len(top_artists)))
+    ax.set_yticklabels([f"{artist}: #{i+1}" for i, artist in top_artists])
 
-    # Add title and axis names
+    # Add title
     if min_year == max_year:
         title = f'Top {top_n} Artists {min_year}'
     else:
         title = f'Top {top_n} Artists {min_year}-{max_year}'
 
-    plt.title(title, fontsize=20, fontweight='bold', color=title_color, pad=padding_amount)
-    plt.ylabel('Artist', fontsize=16, fontweight='bold', color=axis_color, labelpad=padding_amount)
-    plt.xlabel('Hours Listened', fontsize=16, fontweight='bold', color=axis_color, labelpad=padding_amount)
-
-    # Set spines
-    ax.spines['left'].set_zorder(1000)
-    ax.spines['top'].set_visible(False)
-    ax.spines['right'].set_visible(False)
-    ax.spines['bottom'].set_visible(False)
-    ax.spines['left'].set_visible(True)
+    ax.set_title(title, fontsize=20, fontweight='bold', color=title_color, pad=padding_amount)
 
     # Save figure
-    plt.tight_layout()
-    plt.savefig(output_path, dpi=600, bbox_inches='tight')
-
-    plt.clf()
-    plt.close()
+    with span('layout'):
+        fig.tight_layout()
+    with span('savefig'):
+        fig.savefig(output_path, dpi=render_profile['dpi'], bbox_inches='tight')
 
 
-def top_artist_by_year(df, top_artists, years, output_path, top_n=20, darkmode=True):
+def top_artist_by_year(matrix, top_artists, years, output_path, top_n=20, darkmode=True, profile=DEFAULT_RENDER_PROFILE):
     colors = get_discrete_colors()
     axis_color = "#7a7a7a"
     grid_color = "#d4d4d4"
@@ -133,6 +134,7 @@ def top_artist_by_year(df, top_artists, years, output_path, top_n=20, darkmode=T
     padding_amount = 20
 
     plt.rcParams['font.family'] = set_font()
+    render_profile = set_render_profile(profile)
 
     year_colors = colors[:len(years)]
     year_colors.reverse()
@@ -142,20 +144,16 @@ def top_artist_by_year(df, top_artists, years, output_path, top_n=20, darkmode=T
     fig, ax = plt.subplots(figsize=(height*golden_ratio, height))
     plt.grid(True, axis='x', color=grid_color, linewidth=1, zorder=-999, linestyle='--')
 
-    min_year = df['year'].min()
-    max_year = df['year'].max()
+    min_year = min(years)
+    max_year = max(years)
 
-    # Plot the stacked bars
-    for artist in top_artists:
-        bottom = None
-        for i, year in enumerate(years):
-            hours_played_that_year = df.loc[(df['artist'] == artist[1]) & (df['year'] == year), 'ms_played'].values[0]/3600000
+    # Plot the stacked bars, one barh per year with the left edges from a running sum over the years
+    hours_played = matrix.loc[[artist[1] for artist in top_artists], years].values/3600000
+    lefts = np.cumsum(hours_played, axis=1) - hours_played
+    bar_labels = [f"{artist[1]}: #{artist[0]+1}" for artist in top_artists]
 
-            ax.barh(f"{artist[1]}: #{artist[0]+1}", hours_played_that_year, height=0.5, left=bottom, color=year_colors[i], label=year, zorder=999)
-            if bottom is None:
-                bottom = hours_played_that_year
-            else:
-                bottom += hours_played_that_year
+    for i, year in enumerate(years):
+        ax.barh(bar_labels, hours_played[:, i], height=0.5, left=lefts[:, i], color=year_colors[i], label=year, zorder=999)
 
     # Add title and axis names
     plt.title(f'Top {top_n} Artists {min_year}-{max_year} (by Year)', fontsize=20, fontweight='bold', color=title_color, pad=padding_amount)
@@ -178,8 +176,10 @@ def top_artist_by_year(df, top_artists, years, output_path, top_n=20, darkmode=T
     ax.spines['left'].set_visible(True)
 
     # Save figure
-    plt.tight_layout()
-    plt.savefig(output_path, dpi=600, bbox_inches='tight')
+    with span('layout'):
+        plt.tight_layout()
+    with span('savefig'):
+        plt.savefig(output_path, dpi=render_profile['dpi'], bbox_inches='tight')
 
     plt.clf()
     plt.close()
@@ -1,76 +1,68 @@
-from src.plot_formatting import find_cleanest_columns, set_font, get_discrete_colors, get_axis_and_grid_colors
-from matplotlib import pyplot as plt
+from src.plot_formatting import find_cleanest_columns, set_font, get_discrete_colors, get_axis_and_grid_colors, set_render_profile, DEFAULT_RENDER_PROFILE
+from src.cube import top_entities, entity_year_matrix
+from src.figure_templates import get_figure_template
+from src.scheduler import ChartJob, run_chart_jobs
+from src.tracing import traced, span
+from src.lazy_imports import lazy_import
+import numpy as np
 import os
 
+plt = lazy_import('matplotlib.pyplot')
 
-def create_track_charts(df, output_dir, top_n=20, darkmode=True):
-    print(f"TOP TRACKS")
-    print(f"-----------")
+
+def create_track_charts(cube, output_dir, top_n=20, darkmode=True, jobs=1, profile=DEFAULT_RENDER_PROFILE):
+    return run_chart_jobs(plan_track_charts(cube, output_dir, top_n=top_n, darkmode=darkmode, profile=profile), jobs=jobs, output_dir=output_dir)
+
+
+@traced
+def plan_track_charts(cube, output_dir, top_n=20, darkmode=True, profile=DEFAULT_RENDER_PROFILE):
+    section = 'TOP TRACKS'
 
     track_output_dir = os.path.join(output_dir, 'top_tracks')
     if not os.path.exists(track_output_dir):
         os.makedirs(track_output_dir)
 
-    df['sum_hours_played'] = df.groupby(['track', 'artist'])['ms_played'].transform('sum')/3600000
-    df = df.sort_values(by=['sum_hours_played', 'year'], ascending=False)
-
     # create list of tuples of (track, artist) for top_n tracks
-    top_tracks = df.drop_duplicates(subset=['track', 'artist'])[:top_n]
-    top_tracks = [(i, x, y) for i, (x, y) in enumerate(list(zip(top_tracks['track'], top_tracks['artist'])))]
+    top_track_totals = top_entities(cube, ['track', 'artist'], top_n)
+    top_tracks = [(i, x, y) for i, (x, y) in enumerate(top_track_totals.index)]
 
-    full_df = df.copy()
-    full_df = full_df.groupby(['track', 'year', 'artist']).sum()
+    full_df = cube.groupby(['track', 'year', 'artist'], observed=True)['ms_played'].sum()
     full_df = full_df.reset_index()
-    full_df['sum_hours_played'] = full_df.groupby(['track', 'artist'])['ms_played'].transform('sum')/3600000
-    full_df['hours_played'] = full_df.groupby(['track', 'artist', 'year'])['ms_played'].transform('sum')/3600000
-    full_df = full_df.sort_values(by=['sum_hours_played', 'year'], ascending=True)
-    full_df = full_df[['track', 'artist', 'year', 'hours_played', 'sum_hours_played']]
-
-    # filter df by top track and artist
-    df = df[df['track'].isin([x[1] for x in top_tracks]) & df['artist'].isin([x[2] for x in top_tracks])]
-    df = df.groupby(['track', 'year', 'artist']).sum()
-    df = df.reset_index()
 
-    years = df['year'].unique()
-    years.sort()
-
-    # Complete df
-    for year in years:
-        for i, track, artist in top_tracks:
-            year_df = df.loc[df['year'] == year]
-            if not track in year_df['track'].values:
-                # add new row for track, year with ms_played=0
-                df = df.append({'track': track, 'artist': artist, 'year': year, 'ms_played': 0}, ignore_index=True)
+    years = sorted(full_df.loc[full_df.set_index(['track', 'artist']).index.isin(top_track_totals.index), 'year'].unique())
+    matrix = entity_year_matrix(cube, ['track', 'artist'], list(top_track_totals.index), years)
 
+    # long form of the matrix, every (top track, year) pair is present
+    df = matrix.stack().rename('ms_played').reset_index()
     df['sum_hours_played'] = df.groupby(['track', 'artist'])['ms_played'].transform('sum')/3600000
-    df['hours_played'] = df.groupby(['track', 'artist', 'year'])['ms_played'].transform('sum')/3600000
+    df['hours_played'] = df['ms_played']/3600000
     df = df.sort_values(by=['sum_hours_played', 'year'], ascending=True)
-
     df = df[['track', 'artist', 'year', 'hours_played', 'sum_hours_played']]
 
+    full_df['sum_hours_played'] = full_df.groupby(['track', 'artist'], observed=True)['ms_played'].transform('sum')/3600000
+    full_df['hours_played'] = full_df['ms_played']/3600000
+    full_df = full_df.sort_values(by=['sum_hours_played', 'year'], ascending=True)
+    full_df = full_df[['track', 'artist', 'year', 'hours_played', 'sum_hours_played']]
+
     top_tracks.reverse()
 
+    chart_jobs = []
     top_tracks_by_year_path = os.path.join(track_output_dir, 'top_tracks_all_time_by_year.png')
-    if not os.path.exists(top_tracks_by_year_path):
-        top_track_by_year(df, top_tracks, years, top_tracks_by_year_path, top_n=top_n, darkmode=darkmode)
+    chart_jobs.append(ChartJob(section, top_tracks_by_year_path, top_track_by_year, (matrix, top_tracks, years, top_tracks_by_year_path), {'top_n': top_n, 'darkmode': darkmode, 'profile': profile}))
 
     top_tracks_path = os.path.join(track_output_dir, 'top_tracks_all_time.png')
-    if not os.path.exists(top_tracks_path):
-        top_track(df, top_tracks_path, top_n=top_n, darkmode=darkmode)
+    chart_jobs.append(ChartJob(section, top_tracks_path, top_track, (df, top_tracks_path), {'top_n': top_n, 'darkmode': darkmode, 'profile': profile}))
 
     # group full_df by year
     for year in years:
         temp_df = full_df[full_df['year'] == year]
         year_path = os.path.join(track_output_dir, f'top_tracks_{year}.png')
-        if os.path.exists(year_path):
-            continue
-
-        top_track(temp_df, year_path, top_n=top_n, darkmode=darkmode)
+        chart_jobs.append(ChartJob(section, year_path, top_track, (temp_df, year_path), {'top_n': top_n, 'darkmode': darkmode, 'profile': profile}))
 
-    print()
+    return chart_jobs
 
 
-def top_track(df, output_path, top_n, darkmode=True):
+def top_track(df, output_path, top_n, darkmode=True, profile=DEFAULT_RENDER_PROFILE):
     colors = get_discrete_colors()
     axis_color, grid_color = get_axis_and_grid_colors()
 
@@ -86,6 +78,7 @@ def top_track(df, output_path, top_n, darkmode=True):
     padding_amount = 20
 
     plt.rcParams['font.family'] = set_font()
+    render_profile = set_render_profile(profile)
 
     golden_ratio = (1 + 5 ** 0.5) / 2
     height = 10
@@ -94,8 +87,20 @@ def top_track(df, output_path, top_n, darkmode=True):
     label_lengths = [len(f"{track}, {artist}") for track, artist in zip(df['track'], df['artist'])]
     label_adjustment = max(label_lengths) / 15
 
-    fig, ax = plt.subplots(figsize=(height*golden_ratio + label_adjustment, height))
-    plt.grid(True, axis='x', color=grid_color, linewidth=1, zorder=-999, linestyle='--')
+    def build(ax):
+        ax.grid(True, axis='x', color=grid_color, linewidth=1, zorder=-999, linestyle='--')
+        ax.set_ylabel('Track', fontsize=16, fontweight='bold', color=axis_color, labelpad=padding_amount)
+        ax.set_xlabel('Hours Listened', fontsize=16, fontweight='bold', color=axis_color, labelpad=padding_amount)
+
+        # Set spines
+        ax.spines['left'].set_zorder(1000)
+        ax.spines['top'].set_visible(False)
+        ax.spines['right'].set_visible(False)
+        ax.spines['bottom'].set_visible(False)
+        ax.spines['left'].set_visible(True)
+
+    # the skeleton is shared by every track chart in this style, only the size, bars, tick labels and title change
+    fig, ax = get_figure_template(('top_track', darkmode, profile), (height*golden_ratio + label_adjustment, height), build)
 
     min_year = df['year'].min()
     max_year = df['year'].max()
@@ -109,35 +114,27 @@ def top_track(df, output_path, top_n, darkmode=True):
 
     top_tracks.reverse()
 
-    for i, track, artist, hours in top_tracks:
-        ax.barh(f"{track}, {artist}: #{i+1}", hours, color=colors[0], zorder=999, height=0.5)
+    for position, (i, track, artist, hours) in enumerate(top_tracks):
+        ax.barh(position, hours, color=colors[0], zorder=999, height=0.5)
+    ax.set_yticks(range(len(top_tracks)))
+    ax.set_yticklabels([f"{track}, {artist}: #{i+1}" for i, track, artist, hours in top_tracks])
 
-    # Add title and axis names
+    # Add title
     if min_year == max_year:
         title = f'Top {top_n} Tracks {min_year}'
     else:
         title = f'Top {top_n} Tracks {min_year}-{max_year}'
 
-    plt.title(title, fontsize=20, fontweight='bold', color=title_color, pad=padding_amount)
-    plt.ylabel('Track', fontsize=16, fontweight='bold', color=axis_color, labelpad=padding_amount)
-    plt.xlabel('Hours Listened', fontsize=16, fontweight='bold', color=axis_color, labelpad=padding_amount)
-
-    # Set spines
-    ax.spines['left'].set_zorder(1000)
-    ax.spines['top'].set_visible(False)
-    ax.spines['right'].set_visible(False)
-    ax.spines['bottom'].set_visible(False)
-    ax.spines['left'].set_visible(True)
+    ax.set_title(title, fontsize=20, fontweight='bold', color=title_color, pad=padding_amount)
 
     # Save figure
-    plt.tight_layout()
-    plt.savefig(output_path, dpi=600, bbox_inches='tight')
-
-    plt.clf()
-    plt.close()
+    with span('layout'):
+        fig.tight_layout()
+    with span('savefig'):
+        fig.savefig(output_path, dpi=render_profile['dpi'], bbox_inches='tight')
 
 
-def top_track_by_year(df, top_tracks, years, output_path, top_n=20, darkmode=True):
+def top_track_by_year(matrix, top_tracks, years, output_path, top_n=20, darkmode=True, profile=DEFAULT_RENDER_PROFILE):
     colors = get_discrete_colors()
     axis_color = "#7a7a7a"
     grid_color = "#d4d4d4"
@@ -153,6 +150,7 @@ def top_track_by_year(df, top_tracks, years, output_path, top_n=20, darkmode=Tru
     padding_amount = 20
 
     plt.rcParams['font.family'] = set_font()
+    render_profile = set_render_profile(profile)
 
     year_colors = colors[:len(years)]
     year_colors.reverse()
@@ -165,21 +163,16 @@ def top_track_by_year(df, top_tracks, years, output_path, top_n=20, darkmode=Tru
     fig, ax = plt.subplots(figsize=(height*golden_ratio + label_adjustment, height))
     plt.grid(True, axis='x', color=grid_color, linewidth=1, zorder=-999, linestyle='--')
 
-    min_year = df['year'].min()
-    max_year = df['year'].max()
+    min_year = min(years)
+    max_year = max(years)
 
-    # Plot the stacked bars
-    for track in top_tracks:
-        bottom = None
-        for i, year in enumerate(years):
-            slice_df = df.loc[(df['track'] == track[1]) & (df['year'] == year), 'hours_played']
-            hours_played_that_year = slice_df.values[0]
+    # Plot the stacked bars, one barh per year with the left edges from a running sum over the years
+    hours_played = matrix.loc[[(track[1], track[2]) for track in top_tracks], years].values/3600000
+    lefts = np.cumsum(hours_played, axis=1) - hours_played
+    bar_labels = [f"{track[1]}, {track[2]}: #{track[0]+1}" for track in top_tracks]
 
-            ax.barh(f"{track[1]}, {track[2]}: #{track[0]+1}", hours_played_that_year, height=0.5, left=bottom, color=year_colors[i], label=year, zorder=999)
-            if bottom is None:
-                bottom = hours_played_that_year
-            else:
-                bottom += hours_played_that_year
+    for i, year in enumerate(years):
+        ax.barh(bar_labels, hours_played[:, i], height=0.5, left=lefts[:, i], color=year_colors[i], label=year, zorder=999)
 
     # Add title and axis names
     plt.title(f'Top {top_n} Tracks {min_year}-{max_year} (by Year)', fontsize=20, fontweight='bold', color=title_color)
@@ -202,8 +195,10 @@ def top_track_by_year(df, top_tracks, years, output_path, top_n=20, darkmode=Tru
     ax.spines['left'].set_visible(True)
 
     # Save figure
-    plt.tight_layout()
-    plt.savefig(output_path, dpi=600, bbox_inches='tight')
+    with span('layout'):
+        plt.tight_layout()
+    with span('savefig'):
+        plt.savefig(output_path, dpi=render_profile['dpi'], bbox_inches='tight')
 
     plt.clf()
     plt.close()
@@ -0,0 +1,181 @@
+from collections import defaultdict
+import contextlib
+import tracemalloc
+import functools
+import threading
+import time
+import json
+import sys
+import os
+
+try:
+	import resource
+except ImportError:
+	# windows, no peak RSS there
+	resource = None
+
+# the tracer of this process, None while tracing is off. every hook checks it first and does nothing else when off
+_tracer = None
+_NULL_SPAN = contextlib.nullcontext()
+
+TRACEMALLOC_TOP_LINES = 10
+
+
+def _max_rss_mb():
+	# ru_maxrss is in kilobytes on linux and bytes on macos
+	if resource is None:
+		return 0
+	max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return max_rss / 2 ** 20 if sys.platform == 'darwin' else max_rss / 2 ** 10
+
+
+def _wall_us():
+	# wall clock so spans from chart worker processes line up with the parent's
+	return time.time_ns() // 1000
+
+
+class Tracer:
+	def __init__(self, memory=False):
+		self.memory = memory
+		self.pid = os.getpid()
+		self.events = []
+		self.counters = defaultdict(int)
+		self.lock = threading.Lock()
+		self.snapshot = None
+		if memory and not tracemalloc.is_tracing():
+			tracemalloc.start()
+
+	def add_span(self, name, start_us, duration_us, args):
+		args['max_rss_mb'] = round(_max_rss_mb(), 1)
+		if self.memory:
+			current, peak = tracemalloc.get_traced_memory()
+			args['traced_mb'] = round(current / 2 ** 20, 1)
+			args['traced_peak_mb'] = round(peak / 2 ** 20, 1)
+
+		event = {'name': name, 'ph': 'X', 'ts': start_us, 'dur': duration_us, 'pid': self.pid, 'tid': threading.get_ident(), 'args': args}
+		with self.lock:
+			self.events.append(event)
+
+	def count(self, name, value):
+		with self.lock:
+			self.counters[name] += value
+			self.events.append({'name': name, 'ph': 'C', 'ts': _wall_us(), 'pid': self.pid, 'args': {name: self.counters[name]}})
+
+	def stop(self):
+		if self.memory and tracemalloc.is_tracing():
+			self.snapshot = tracemalloc.take_snapshot()
+			tracemalloc.stop()
+
+	def export(self):
+		# what a worker process sends back to be merged into the parent's trace
+		return self.events, dict(self.counters)
+
+	def merge(self, events, counters):
+		with self.lock:
+			self.events.extend(events)
+			for name, value in counters.items():
+				self.counters[name] += value
+
+
+class Span:
+	def __init__(self, tracer, name, args):
+		self.tracer = tracer
+		self.name = name
+		self.args = args
+
+	def __enter__(self):
+		self.start_us = _wall_us()
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, *exc):
+		duration_us = int((time.perf_counter() - self.start) * 1e6)
+		self.tracer.add_span(self.name, self.start_us, duration_us, self.args)
+		return False
+
+
+def start_tracing(memory=False):
+	# memory=True also runs tracemalloc, which slows allocation heavy code down noticeably
+	global _tracer
+	_tracer = Tracer(memory=memory)
+	return _tracer
+
+
+def stop_tracing():
+	global _tracer
+	tracer, _tracer = _tracer, None
+	if tracer is not None:
+		tracer.stop()
+	return tracer
+
+
+def is_tracing():
+	return _tracer is not None
+
+
+def trace_settings():
+	# None when off, otherwise what a worker process needs to trace the same way
+	return None if _tracer is None else {'memory': _tracer.memory}
+
+
+def span(name, **args):
+	if _tracer is None:
+		return _NULL_SPAN
+	return Span(_tracer, name, args)
+
+
+def traced(func):
+	@functools.wraps(func)
+	def wrapper(*args, **kwargs):
+		if _tracer is None:
+			return func(*args, **kwargs)
+		with Span(_tracer, func.__name__, {}):
+			return func(*args, **kwargs)
+	return wrapper
+
+
+def count(name, value=1):
+	if _tracer is not None:
+		_tracer.count(name, value)
+
+
+def merge_trace(exported):
+	if _tracer is not None and exported is not None:
+		_tracer.merge(*exported)
+
+
+def write_chrome_trace(tracer, path):
+	# loads in chrome://tracing and https://ui.perfetto.dev
+	events = sorted(tracer.events, key=lambda event: event['ts'])
+	temp_path = f'{path}.tmp'
+	with open(temp_path, 'w') as fp:
+		json.dump({'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'counters': dict(tracer.counters)}}, fp)
+	os.replace(temp_path, path)
+
+
+def print_trace_summary(tracer):
+	# spans with the same name are added up, nested spans count toward their parents too
+	stats = {}
+	for event in tracer.events:
+		if event['ph'] != 'X':
+			continue
+		calls, total, longest, max_rss = stats.get(event['name'], (0, 0, 0, 0))
+		stats[event['name']] = (calls + 1, total + event['dur'], max(longest, event['dur']), max(max_rss, event['args']['max_rss_mb']))
+
+	print('TRACE SUMMARY')
+	print('-------------')
+	print(f"{'span':<32} {'calls':>6} {'total s':>9} {'mean ms':>9} {'max ms':>9} {'max rss MB':>11}")
+	for name, (calls, total, longest, max_rss) in sorted(stats.items(), key=lambda item: -item[1][1]):
+		print(f'{name[:32]:<32} {calls:>6} {total / 1e6:>9.3f} {total / calls / 1e3:>9.1f} {longest / 1e3:>9.1f} {max_rss:>11.1f}')
+
+	if tracer.counters:
+		print()
+		for name, value in sorted(tracer.counters.items()):
+			print(f'{name:<32} {value:>10}')
+
+	if tracer.snapshot is not None:
+		print()
+		print('largest allocations still alive at the end of the run:')
+		for stat in tracer.snapshot.statistics('lineno')[:TRACEMALLOC_TOP_LINES]:
+			print(f'  {stat.size / 2 ** 20:>8.1f} MB  {stat.traceback}')
+	print()
@@ -0,0 +1,15 @@
+from src.synthetic_history import generate_history
+from src.streamgraphs import plan_streamgraphs
+from src.history import SpotifyHistory
+from main import load_data
+import os
+
+
+def test_streamgraph_renders(tmp_path):
+	json_dir, output_dir = str(tmp_path / 'json'), str(tmp_path / 'output')
+	generate_history(json_dir, 2000, num_years=1)
+	history = SpotifyHistory(*load_data(json_dir, output_dir))
+
+	job = plan_streamgraphs(history, output_dir, top_n=5, profile='draft')[0]
+	job.func(*job.args, **job.kwargs)
+	assert os.path.getsize(job.output_path) > 0
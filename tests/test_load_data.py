@@ -0,0 +1,56 @@
+from src.synthetic_history import generate_history
+from src.ingest import stream_history_files
+from main import load_data
+import json
+import os
+
+
+def write_bad_file(json_dir, name, records=()):
+	# valid records first, then one that never closes
+	text = '[' + ''.join(json.dumps(record) + ', ' for record in records) + '{"ts": "2021-01-01T00:00:00Z", "ms_played": ' + ' ' * 1000000
+	with open(os.path.join(json_dir, name), 'w') as fp:
+		fp.write(text)
+
+
+def test_stream_keeps_cache_when_no_new_file_parses(tmp_path, capsys):
+	json_dir, output_dir = str(tmp_path / 'json'), str(tmp_path / 'output')
+	generate_history(json_dir, 2000, records_per_file=1000)
+	df, podcasts_df = load_data(json_dir, output_dir, stream=True)
+
+	write_bad_file(json_dir, 'Streaming_History_Audio_2030_9.json')
+	capsys.readouterr()
+	new_df, new_podcasts_df = load_data(json_dir, output_dir, stream=True)
+	assert 'keeping the cached plays' in capsys.readouterr().out
+	assert (len(new_df), len(new_podcasts_df)) == (len(df), len(podcasts_df))
+	assert new_df['ts'].dtype == df['ts'].dtype
+
+	# the bad file went into the manifest, so nothing is read the third time
+	load_data(json_dir, output_dir, stream=True)
+	assert '- Loading data from cache...' in capsys.readouterr().out
+
+
+def test_stream_drops_partly_parsed_files(tmp_path):
+	json_dir = str(tmp_path / 'json')
+	paths = generate_history(json_dir, 1000, records_per_file=500)
+	with open(paths[0], 'rb') as fp:
+		records = json.loads(fp.read().decode('utf-8-sig'))
+	write_bad_file(json_dir, 'Streaming_History_Audio_2030_9.json', records[:10])
+
+	df, podcasts_df = stream_history_files(paths + [os.path.join(json_dir, 'Streaming_History_Audio_2030_9.json')])
+	assert len(df) + len(podcasts_df) == 1000
+	assert stream_history_files([os.path.join(json_dir, 'Streaming_History_Audio_2030_9.json')]) is None
+
+
+def test_reading_modes_merge_without_nans(tmp_path):
+	json_dir, output_dir = str(tmp_path / 'json'), str(tmp_path / 'output')
+	paths = generate_history(json_dir, 2000, records_per_file=1000)
+	held_back = paths[-1] + '.held'
+	os.rename(paths[-1], held_back)
+	load_data(json_dir, output_dir, jobs=1)
+
+	# the cache has every column of the pool reader, the new file is streamed
+	os.rename(held_back, paths[-1])
+	df, podcasts_df = load_data(json_dir, output_dir, stream=True)
+	assert len(df) + len(podcasts_df) == 2000
+	assert not df.isna().all().any() and not podcasts_df.isna().all().any()
+	assert not df[['ts', 'ms_played', 'spotify_track_uri']].isna().any().any()